@@ -1,14 +1,57 @@
-from typing import Dict, List
+from typing import Any, Dict, List
+
+from collections import OrderedDict
+import copy
+import hashlib
+import itertools
+import multiprocessing
+import queue
+from multiprocessing.pool import Pool
 
 from overrides import overrides
 
+import torch
+import torch.distributed as dist
+
 from allennlp.training.metrics import Metric
 
-from .utils.smatch_edited import SmatchScript
+from .utils.smatch_cache import PairScoreCache
+from .utils.smatch_edited import SmatchCounts, SmatchScript, init_worker, make_gold_cache, \
+    process_pairs_in_pool, score_worker_loop
+from .utils.smatch_significance import sample_moments, sample_standard_error
 
 import logging
 logging.getLogger('amr_postprocessing').setLevel(logging.CRITICAL)
 
+# gloo process group used for reducing smatch counts, see all_reduce_smatch_counts
+_gloo_group = None
+# seconds close waits for a background process to stop before terminating it
+BACKGROUND_JOIN_TIMEOUT = 5.0
+
+
+def all_reduce_ints(values: List[int], group: Any = None) -> List[int]:
+    """
+    Sum integer lists of all processes of the distributed group.
+    Values are reduced as int64 CPU tensors, so a gloo group is used. If the group is not
+    given, a gloo group over all processes is created on the first call (collectively,
+    so all processes have to call this function).
+    """
+    global _gloo_group
+    if group is None:
+        if _gloo_group is None:
+            _gloo_group = dist.new_group(backend='gloo')
+        group = _gloo_group
+    tensor = torch.tensor(values, dtype=torch.long)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM, group=group)
+    return tensor.tolist()
+
+
+def all_reduce_smatch_counts(counts: SmatchCounts, group: Any = None) -> SmatchCounts:
+    """
+    Sum smatch counts of all processes of the distributed group (see all_reduce_ints).
+    """
+    return SmatchCounts(*all_reduce_ints(counts.to_list(), group))
+
 
 @Metric.register('smatch')
 class Smatch(Metric):
@@ -23,14 +66,93 @@ class Smatch(Metric):
                  restart_number: int = 4,
                  just_instance: bool = False,
                  just_attribute: bool = False,
-                 just_relation: bool = False):
+                 just_relation: bool = False,
+                 engine: str = 'dict',
+                 seed: int = None,
+                 num_workers: int = 0,
+                 distributed: bool = False,
+                 gold_cache_size: int = 5000,
+                 gold_cache_bytes: int = None,
+                 score_cache_size: int = 0,
+                 score_cache_path: str = None,
+                 max_time: float = None,
+                 max_steps: int = None,
+                 exact_threshold: int = 0,
+                 fine_grained: bool = False,
+                 sample_rate: float = 1.0,
+                 sample_seed: int = 0,
+                 full_every: int = 0,
+                 asynchronous: bool = False):
         """
         Look original smatch evaluation script for reference.
+        `engine` selects hill-climbing implementation: 'dict' (original) or 'dense' (NumPy arrays).
+        `seed` makes random restarts reproducible.
+        `num_workers` > 0 scores AMR pairs in a pool of worker processes
+        (created on the first call and kept between resets, until close is called).
+        `distributed` sums counts of all processes of the initialized torch.distributed
+        group when the final metric is requested (get_metric with reset).
+        `gold_cache_size` is the maximal number of gold AMRs kept parsed and indexed between
+        validation epochs (least recently used are evicted), 0 disables the cache. It counts AMRs,
+        not memory, gold AMRs differ a lot in size. `gold_cache_bytes` additionally limits the estimated
+        memory of the cached AMRs (see PreparedAMR.estimated_size), None for no memory limit.
+        With worker processes every worker keeps its own cache with these limits.
+        `score_cache_size` > 0 caches scores of (prediction, gold) pairs in memory, so repeated
+        pairs skip hill-climbing; `score_cache_path` adds an SQLite file tier shared between runs
+        (given alone, the memory tier gets the default size of PairScoreCache).
+        `max_time` (seconds) and `max_steps` (hill-climbing steps) limit the mapping search of one pair,
+        the best mapping found so far is used when the budget runs out, so huge pairs can not stall validation.
+        `exact_threshold` > 0 scores pairs of AMRs with at most this number of nodes exactly (branch-and-bound),
+        which gives deterministic scores of small graphs without restarts. It is off by default, as exact scores
+        can be higher than the hill-climbing ones and would change the reported SMATCH; enable it in the config
+        (e.g. `"smatch": {"exact_threshold": 10}` of the model).
+        `fine_grained` adds F-scores of Unlabeled, No WSD, Concepts, NER, Negations, Wikification,
+        Reentrancies and SRL, computed from the same best node mapping (no extra alignment).
+        `sample_rate` < 1 scores only this fraction of pairs. The subset is fixed: a pair is selected by
+        a hash of its gold AMR and `sample_seed`, so every epoch is scored on the same pairs. Sampled
+        epochs report the estimate with its standard error as SMATCH_stderr (0 for full epochs).
+        `full_every` > 0 scores all pairs every `full_every` epochs (epochs are counted by get_metric
+        with reset), starting with the first one, so a standalone evaluation is always full.
+        `asynchronous` scores pairs in background processes (`num_workers` of them, at least one),
+        so the call returns immediately and scoring overlaps with the model forward passes.
+        get_metric without reset reports the pairs scored so far, get_metric with reset waits for the backlog.
+        The processes live until close is called (or the metric is deleted).
         """
         self.restart_number = restart_number
         self.just_instance = just_instance
         self.just_attribute = just_attribute
         self.just_relation = just_relation
+        self.engine = engine
+        self.seed = seed
+        self.num_workers = num_workers
+        self.distributed = distributed
+        self.gold_cache_size = gold_cache_size
+        self.gold_cache_bytes = gold_cache_bytes
+        self.max_time = max_time
+        self.max_steps = max_steps
+        self.exact_threshold = exact_threshold
+        self.fine_grained = fine_grained
+        self.sample_rate = sample_rate
+        self.sample_seed = sample_seed
+        self.full_every = full_every
+        self.asynchronous = asynchronous
+
+        self._epoch = 0
+        # number of pairs the current epoch sample is drawn from
+        self._population_size = 0
+        self._pool = None
+        # background scoring processes and their queues, see _submit
+        self._processes = []
+        self._tasks = None
+        self._results = None
+        self._batch_ids = itertools.count()
+        # batch id -> (pairs, scores), scores of pairs still being scored are None
+        self._pending = OrderedDict()
+        # Gold AMRs do not change between epochs, so the cache lives across resets
+        self._gold_cache = make_gold_cache(gold_cache_size, gold_cache_bytes)
+        self._score_cache = None
+        if score_cache_size > 0 or score_cache_path:
+            self._score_cache = PairScoreCache(max_size=score_cache_size or PairScoreCache.MEMORY_SIZE,
+                                               path=score_cache_path)
 
         # As metric state we use SmatchScript object
         self.state: SmatchScript = None
@@ -43,6 +165,20 @@ class Smatch(Metric):
         """
         Accumulate statistics on batch of predictions and targets.
         """
+        if self._sampled_epoch():
+            self._population_size += len(gold_labels)
+            selected = [k for k, gold_label in enumerate(gold_labels) if self._in_sample(gold_label)]
+            predictions = [predictions[k] for k in selected]
+            gold_labels = [gold_labels[k] for k in selected]
+
+        if self.asynchronous:
+            self._submit(list(zip(predictions, gold_labels)))
+            return
+
+        if self.num_workers > 0:
+            process_pairs_in_pool(self.state, zip(predictions, gold_labels), self._get_pool())
+            return
+
         for prediction, gold_label in zip(predictions, gold_labels):
             self.state.process_instance(prediction, gold_label)
 
@@ -51,8 +187,25 @@ class Smatch(Metric):
         """
         Calculate final metrics score out of accumulated statistics.
         """
+        if self.asynchronous:
+            self._collect(wait=reset)
+        sampled = self._sampled_epoch()
+        if sampled:
+            moments = sample_moments(self.state.pair_counts)
+            population_size = self._population_size
+        if reset and self.distributed and dist.is_available() and dist.is_initialized():
+            self.state.counts = all_reduce_smatch_counts(self.state.counts)
+            if self.state.fine_counts is not None:
+                for name, counts in self.state.fine_counts.items():
+                    self.state.fine_counts[name] = all_reduce_smatch_counts(counts)
+            if sampled:
+                reduced = all_reduce_ints(moments + [population_size])
+                moments, population_size = reduced[:-1], reduced[-1]
         metrics_dict = self.state.get_metrics()
+        if self.sample_rate < 1:
+            metrics_dict['SMATCH_stderr'] = sample_standard_error(moments, population_size) if sampled else 0.0
         if reset:
+            self._epoch += 1
             self.reset()
         return metrics_dict
 
@@ -61,7 +214,145 @@ class Smatch(Metric):
         """
         Prepare new state instead of manually resetting statistics.
         """
-        self.state = SmatchScript(r=self.restart_number,
-                                  justinstance=self.just_instance,
-                                  justattribute=self.just_attribute,
-                                  justrelation=self.just_relation)
+        if self._pending:
+            # scores of the previous state must not end up in the new one
+            self._collect(wait=True)
+        if self._score_cache is not None:
+            self._score_cache.flush()
+        # per-pair counts are only needed for the standard error of sampled epochs
+        self.state = SmatchScript(gold_cache=self._gold_cache,
+                                  score_cache=self._score_cache,
+                                  keep_pair_counts=self.sample_rate < 1,
+                                  **self._script_kwargs())
+        self._population_size = 0
+
+    def _sampled_epoch(self) -> bool:
+        if self.sample_rate >= 1:
+            return False
+        return not (self.full_every > 0 and self._epoch % self.full_every == 0)
+
+    def _in_sample(self, gold_label: str) -> bool:
+        # Stable across processes and runs, unlike built-in hash of strings
+        digest = hashlib.sha1('{0}\t{1}'.format(self.sample_seed, gold_label).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') < self.sample_rate * (1 << 64)
+
+    def _script_kwargs(self) -> Dict[str, Any]:
+        return dict(r=self.restart_number,
+                    justinstance=self.just_instance,
+                    justattribute=self.just_attribute,
+                    justrelation=self.just_relation,
+                    engine=self.engine,
+                    seed=self.seed,
+                    max_time=self.max_time,
+                    max_steps=self.max_steps,
+                    exact_threshold=self.exact_threshold,
+                    fine_grained=self.fine_grained)
+
+    def _get_pool(self) -> Pool:
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.num_workers,
+                                              initializer=init_worker,
+                                              initargs=(self._script_kwargs(), self.gold_cache_size,
+                                                        self.gold_cache_bytes))
+        return self._pool
+
+    def close(self) -> None:
+        """
+        Terminate the worker pool and stop the background processes, new ones are created by the next call
+        that needs them. Scores of pairs still being scored in the background are discarded.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._processes:
+            # one sentinel per process, see score_worker_loop
+            for _ in self._processes:
+                self._tasks.put(None)
+            for process in self._processes:
+                process.join(timeout=BACKGROUND_JOIN_TIMEOUT)
+                if process.is_alive():
+                    # e.g. still scoring a large backlog or blocked on results nobody reads
+                    process.terminate()
+                    process.join()
+            self._tasks.close()
+            self._results.close()
+            self._processes = []
+            self._tasks = None
+            self._results = None
+            self._pending = OrderedDict()
+
+    def __del__(self) -> None:
+        # the metric may be deleted before __init__ finished
+        if getattr(self, '_pool', None) is not None or getattr(self, '_processes', None):
+            self.close()
+
+    def _submit(self, pairs: List[Any]) -> None:
+        # Cached scores are looked up here, the other pairs are sent to the background processes
+        if not self._processes:
+            self._start_background()
+        scores = [self.state.lookup_score(*pair) for pair in pairs]
+        todo = [pair for pair, pair_scores in zip(pairs, scores) if pair_scores is None]
+        batch_id = next(self._batch_ids)
+        self._pending[batch_id] = (pairs, scores)
+        if todo:
+            self._tasks.put((batch_id, todo))
+        self._apply_finished()
+
+    def _collect(self, wait: bool) -> None:
+        # Accumulate received scores, with wait until all submitted pairs are scored
+        while self._pending:
+            try:
+                batch_id, todo_scores, search_stats = self._results.get(block=wait, timeout=1.0 if wait else None)
+            except queue.Empty:
+                if not wait:
+                    return
+                if not all(process.is_alive() for process in self._processes):
+                    raise RuntimeError("Background smatch process exited unexpectedly")
+                continue
+            pairs, scores = self._pending[batch_id]
+            self.state.add_search_stats(search_stats)
+            todo_scores = iter(todo_scores)
+            for k, pair_scores in enumerate(scores):
+                if pair_scores is None:
+                    scores[k] = next(todo_scores)
+                    self.state.store_score(*pairs[k], scores[k])
+            self._apply_finished()
+
+    def _apply_finished(self) -> None:
+        # Batches are accumulated in the order of calls, so the result is the same as synchronous scoring
+        while self._pending:
+            batch_id, (pairs, scores) = next(iter(self._pending.items()))
+            if any(pair_scores is None for pair_scores in scores):
+                return
+            del self._pending[batch_id]
+            for pair_scores in scores:
+                self.state.add_instance_score(*pair_scores)
+
+    def _start_background(self) -> None:
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        for _ in range(max(self.num_workers, 1)):
+            process = multiprocessing.Process(target=score_worker_loop,
+                                              args=(self._script_kwargs(), self.gold_cache_size,
+                                                    self.gold_cache_bytes,
+                                                    self._tasks, self._results),
+                                              daemon=True)
+            process.start()
+            self._processes.append(process)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Worker pool and background processes can not be pickled or copied, new ones are created on demand
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_processes'] = []
+        state['_tasks'] = None
+        state['_results'] = None
+        state['_batch_ids'] = itertools.count()
+        state['_pending'] = OrderedDict()
+        # Cached gold AMRs hold symbol ids of this process (see amr.SymbolTable), which mean nothing in another one
+        state['_gold_cache'] = make_gold_cache(self.gold_cache_size, self.gold_cache_bytes)
+        if self.state is not None:
+            state['state'] = copy.copy(self.state)
+            state['state'].gold_cache = state['_gold_cache']
+        return state
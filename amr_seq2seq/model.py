@@ -1,5 +1,10 @@
 from typing import List, Dict, Any
 
+import math
+import multiprocessing
+from multiprocessing.pool import Pool
+
+import numpy
 from overrides import overrides
 
 import torch
@@ -13,6 +18,7 @@ from allennlp.training.metrics import Metric
 
 from .metrics import Smatch
 from .utils import postprocess_AMRs
+from .utils.smatch_edited import SmatchScript
 
 
 @Model.register('translation')
@@ -33,7 +39,23 @@ class TranslationModel(SimpleSeq2Seq):
                  source_field: str,
                  target_field: str,
                  raw_target_field: str = 'raw_amr',
-                 use_bleu: bool = True):
+                 use_bleu: bool = True,
+                 smatch: Metric = None,
+                 mbr_size: int = 0,
+                 mbr_restart_number: int = 4,
+                 mbr_seed: int = 0,
+                 mbr_exact_threshold: int = 10,
+                 postprocess_workers: int = 0):
+        """
+        `mbr_size` > 1 enables minimum Bayes risk decoding: the `mbr_size` best beam search hypotheses
+        are postprocessed and the one with the highest average Smatch with the others is predicted
+        instead of the top one (`mbr_restart_number` hill-climbing restarts per pair).
+        `mbr_seed` (None for random restarts) and `mbr_exact_threshold` (exact search of pairs with at most
+        this number of nodes, 0 disables it) keep the selection deterministic by default, see Smatch.
+        `postprocess_workers` > 0 postprocesses predicted AMRs of a batch in a pool of worker processes
+        (created on the first call and kept between batches, until close is called), one chunk of the batch
+        per worker.
+        """
         super().__init__(vocab=vocab,
                          source_embedder=source_embedder,
                          encoder=encoder,
@@ -47,7 +69,15 @@ class TranslationModel(SimpleSeq2Seq):
         self.target_field = target_field
         self.raw_target_field = raw_target_field
 
-        self._smatch: Metric = Smatch(restart_number=10)
+        self._smatch: Metric = smatch or Smatch(restart_number=10)
+
+        self.mbr_size = mbr_size
+        self._mbr_scorer = None
+        if mbr_size > 1:
+            self._mbr_scorer = SmatchScript(r=mbr_restart_number, seed=mbr_seed, exact_threshold=mbr_exact_threshold)
+
+        self.postprocess_workers = postprocess_workers
+        self._postprocess_pool = None
 
     @overrides
     def forward(self,
@@ -81,19 +111,46 @@ class TranslationModel(SimpleSeq2Seq):
         For finalizing predictions, postprocessing similar to
         Noord and Bos (2017) is done.
         """
+        if self.postprocess_workers > 0 and len(batch_text) > 1:
+            # map keeps the order of the batch
+            chunk_size = math.ceil(len(batch_text) / self.postprocess_workers)
+            return self._get_postprocess_pool().map(postprocess_AMRs.process_item, batch_text, chunk_size)
+
         batch_amrs = []
         for text in batch_text:
             amr = postprocess_AMRs.process_item(text)
             batch_amrs.append(amr)
         return batch_amrs
 
+    def _get_postprocess_pool(self) -> Pool:
+        if self._postprocess_pool is None:
+            self._postprocess_pool = multiprocessing.Pool(self.postprocess_workers)
+        return self._postprocess_pool
+
+    def close(self) -> None:
+        """
+        Terminate the postprocessing pool, a new one is created by the next batch that needs it.
+        """
+        if self._postprocess_pool is not None:
+            self._postprocess_pool.terminate()
+            self._postprocess_pool.join()
+            self._postprocess_pool = None
+
+    def __del__(self) -> None:
+        # the model may be deleted before __init__ finished
+        if getattr(self, '_postprocess_pool', None) is not None:
+            self.close()
+
     @overrides
     def decode(self, output_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """
         Finalize predictions. Tensors are converted back into tokens using
         the vocabulary. Tokens are then concatenated to get a linearized amrs.
         Finally, postprocessing is done to get valid amr representations.
+        With minimum Bayes risk decoding the consensus hypothesis of the beam is chosen.
         """
+        if self._mbr_scorer is not None and len(output_dict['predictions'].shape) == 3:
+            return self.decode_consensus(output_dict)
 
         # Prepare tokens
         output_dict = super().decode(output_dict)
@@ -111,6 +168,58 @@ class TranslationModel(SimpleSeq2Seq):
 
         return output_dict
 
+    def decode_consensus(self, output_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """
+        Finalize predictions choosing the consensus of `mbr_size` best hypotheses of every beam.
+        The index of the chosen hypothesis is stored as `consensus_index`.
+        """
+        predicted_indices = output_dict['predictions']
+        if not isinstance(predicted_indices, numpy.ndarray):
+            predicted_indices = predicted_indices.detach().cpu().numpy()
+
+        batch_candidate_tokens = [[self.indices_to_tokens(indices) for indices in beam_indices[:self.mbr_size]]
+                                  for beam_indices in predicted_indices]
+        batch_candidate_text = [[self.detokenize(tokens) for tokens in candidate_tokens]
+                                for candidate_tokens in batch_candidate_tokens]
+        # candidates of the whole batch are postprocessed at once
+        all_amrs = iter(self.postprocess_predicted_text([text for candidate_text in batch_candidate_text
+                                                         for text in candidate_text]))
+
+        batch_tokens, batch_text, batch_amrs, batch_choices = [], [], [], []
+        for candidate_tokens, candidate_text in zip(batch_candidate_tokens, batch_candidate_text):
+            candidate_amrs = [next(all_amrs) for _ in candidate_text]
+            choice = self.select_consensus(candidate_amrs)
+            batch_tokens.append(candidate_tokens[choice])
+            batch_text.append(candidate_text[choice])
+            batch_amrs.append(candidate_amrs[choice])
+            batch_choices.append(choice)
+
+        output_dict['predicted_tokens'] = batch_tokens
+        output_dict['predicted_text'] = batch_text
+        output_dict['predicted_amr'] = batch_amrs
+        output_dict['consensus_index'] = batch_choices
+        return output_dict
+
+    def select_consensus(self, candidate_amrs: List[str]) -> int:
+        """
+        Index of the AMR with the highest average Smatch with the other candidates,
+        ties are resolved in favour of the better ranked candidate.
+        """
+        if len(candidate_amrs) < 2:
+            return 0
+        f_scores = self._mbr_scorer.pairwise_f_scores(candidate_amrs)
+        agreement = [sum(row) - row[k] for k, row in enumerate(f_scores)]
+        return max(range(len(candidate_amrs)), key=lambda k: (agreement[k], -k))
+
+    def indices_to_tokens(self, indices: numpy.ndarray) -> List[str]:
+        """
+        Convert predicted indices up to the first end symbol into target tokens.
+        """
+        indices = list(indices)
+        if self._end_index in indices:
+            indices = indices[:indices.index(self._end_index)]
+        return [self.vocab.get_token_from_index(x, namespace=self._target_namespace) for x in indices]
+
     def detokenize(self, tokens: List[str]) -> str:
         """
         Detokenize given lists of tokens. If the does not provide detokenization
@@ -132,3 +241,9 @@ class TranslationModel(SimpleSeq2Seq):
             all_metrics.update(self._smatch.get_metric(reset=reset))
 
         return all_metrics
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Worker pool can not be pickled or copied, a new one is created on demand
+        state = self.__dict__.copy()
+        state['_postprocess_pool'] = None
+        return state
@@ -7,11 +7,17 @@ For detailed description of AMR, see http://www.isi.edu/natural-language/amr/a.p
 
 """
 
+from array import array
 from collections import defaultdict
 import sys
 
 import logging
 
+try:
+    from .lru_cache import LRUCache
+except:
+    from lru_cache import LRUCache
+
 logger = logging.getLogger('amr_postprocessing')
 
 # change this if needed
@@ -20,6 +26,12 @@ ERROR_LOG = sys.stderr
 # change this if needed
 DEBUG_LOG = sys.stderr
 
+# default number of parsed lines kept by parse_AMR_line_cached
+PARSE_CACHE_SIZE = 10000
+
+# number of symbols above which trim_symbols resets the symbol table
+MAX_SYMBOLS = 1 << 20
+
 
 class AMR(object):
     """
@@ -404,6 +416,423 @@ class AMR(object):
         return result_amr
 
 
+def normalize_label(name):
+    """
+    Label as compared by smatch: lowercased, without trailing quote signifiers.
+
+    """
+    return name.lower().rstrip('_')
+
+
+class SymbolTable(object):
+    """
+    Interned strings (concepts, relation and attribute names, constants) and their integer ids.
+    normalized[symbol_id] is the id of the normalized string (see normalize_label), so labels
+    compared by smatch are equal exactly when their normalized ids are.
+    Ids are local to the process (worker processes intern their own symbols) and to the generation
+    of the table: clear starts a new generation, ids of the old one must not be used any more.
+    So ids can not be pickled or sent to other processes, only values computed from them (e.g. scores).
+
+    """
+    __slots__ = ('ids', 'names', 'normalized', 'generation')
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.normalized = []
+        self.generation = 0
+
+    def intern(self, name):
+        """
+        Get id of the string, adding it to the table if it is new.
+
+        """
+        symbol_id = self.ids.get(name)
+        if symbol_id is None:
+            symbol_id = len(self.names)
+            self.ids[name] = symbol_id
+            self.names.append(name)
+            self.normalized.append(symbol_id)
+            label = normalize_label(name)
+            if label != name:
+                self.normalized[symbol_id] = self.intern(label)
+        return symbol_id
+
+    def normalized_id(self, name):
+        """
+        Get id of the normalized string.
+
+        """
+        return self.normalized[self.intern(name)]
+
+    def clear(self):
+        """
+        Remove all symbols and start a new generation.
+
+        """
+        self.ids.clear()
+        del self.names[:]
+        del self.normalized[:]
+        self.generation += 1
+
+    def __len__(self):
+        return len(self.names)
+
+
+# symbols of all CompactAMR graphs, bounded by trim_symbols
+SYMBOLS = SymbolTable()
+
+
+class CompactAMR(object):
+    """
+    Compact AMR graph with the same content as AMR, but stored in parallel arrays:
+    nodes: list of node names
+    root: root node name (the original one, as in AMR it is not changed by rename_node)
+    concepts: symbol ids (see SYMBOLS) of node values
+    edge_source, edge_target, edge_label: relations, as indices of the two nodes and symbol id of the relation name
+    attribute_node, attribute_label, attribute_value: attributes, as node index and symbol ids of the attribute
+                                                      name and the constant value
+    Relations and attributes are ordered by their node, so get_triples returns the same triples in the same order
+    as AMR.get_triples of the same line, and renaming nodes does not touch the edges.
+
+    """
+    __slots__ = ('nodes', 'root', 'concepts', 'edge_source', 'edge_target', 'edge_label',
+                 'attribute_node', 'attribute_label', 'attribute_value')
+
+    def __init__(self, nodes=None):
+        self.nodes = nodes if nodes is not None else []
+        self.root = self.nodes[0] if self.nodes else None
+        self.concepts = array('i')
+        self.edge_source = array('i')
+        self.edge_target = array('i')
+        self.edge_label = array('i')
+        self.attribute_node = array('i')
+        self.attribute_label = array('i')
+        self.attribute_value = array('i')
+
+    @property
+    def node_values(self):
+        names = SYMBOLS.names
+        return [names[concept] for concept in self.concepts]
+
+    def rename_node(self, prefix):
+        """
+        Rename AMR graph nodes to prefix + node_index to avoid nodes with the same name in two different AMRs.
+
+        """
+        self.nodes = [prefix + str(i) for i in range(len(self.nodes))]
+
+    def get_triples(self, prefix=None):
+        """
+        Get the instance, attribute and relation triples in three lists (see AMR.get_triples).
+        With prefix, nodes are named prefix + node_index as after rename_node, without modifying the graph.
+
+        """
+        names = SYMBOLS.names
+        nodes = self.nodes if prefix is None else [prefix + str(i) for i in range(len(self.nodes))]
+        instance_triple = [("instance", nodes[i], names[concept]) for i, concept in enumerate(self.concepts)]
+        attribute_triple = [(names[label], nodes[i], names[value])
+                            for i, label, value in zip(self.attribute_node, self.attribute_label, self.attribute_value)]
+        relation_triple = [(names[label], nodes[source], nodes[target])
+                           for source, target, label in zip(self.edge_source, self.edge_target, self.edge_label)]
+        return instance_triple, attribute_triple, relation_triple
+
+    def get_triples2(self):
+        """
+        Get the instance triples and the relation triples together with the attribute ones (see AMR.get_triples2).
+
+        """
+        names = SYMBOLS.names
+        nodes = self.nodes
+        instance_triple = [("instance", nodes[i], names[concept]) for i, concept in enumerate(self.concepts)]
+        relation_triple = []
+        e = a = 0
+        for i in range(len(nodes)):
+            while e < len(self.edge_source) and self.edge_source[e] == i:
+                relation_triple.append((names[self.edge_label[e]], nodes[i], nodes[self.edge_target[e]]))
+                e += 1
+            while a < len(self.attribute_node) and self.attribute_node[a] == i:
+                relation_triple.append((names[self.attribute_label[a]], nodes[i], names[self.attribute_value[a]]))
+                a += 1
+        return instance_triple, relation_triple
+
+    def to_amr(self):
+        """
+        Convert to AMR object.
+
+        """
+        names = SYMBOLS.names
+        relation_list = [{} for _ in self.nodes]
+        attribute_list = [{} for _ in self.nodes]
+        for source, target, label in zip(self.edge_source, self.edge_target, self.edge_label):
+            relation_list[source][self.nodes[target]] = names[label]
+        for i, label, value in zip(self.attribute_node, self.attribute_label, self.attribute_value):
+            attribute_list[i][names[label]] = names[value]
+        return AMR(self.nodes, self.node_values, relation_list, attribute_list)
+
+    def __str__(self):
+        return str(self.to_amr())
+
+    def __repr__(self):
+        return self.__str__()
+
+    @staticmethod
+    def parse_AMR_line(line):
+        """
+        Parse a AMR from line representation to a CompactAMR object.
+        Accepts the same lines and gives the same triples as AMR.parse_AMR_line. Well-formed lines are split
+        into tokens by str methods and scanned one node, relation or closing parenthesis at a time; any other line
+        is parsed by AMR.parse_AMR_line and converted (so malformed lines give None or raise as there).
+
+        """
+        line = line.strip()
+        result_amr = CompactAMR._parse_well_formed(line)
+        if result_amr is None:
+            amr_graph = AMR.parse_AMR_line(line)
+            if amr_graph is None:
+                return None
+            result_amr = CompactAMR.from_amr(amr_graph)
+        return result_amr
+
+    @staticmethod
+    def _parse_well_formed(line):
+        """
+        Parse a line with one root and balanced parentheses, where every node is "(name / concept" followed by
+        ":relation value" or ":relation (" items and ")", and quoted values are single words.
+        Returns CompactAMR or None if the line has any other form (it is then left to AMR.parse_AMR_line,
+        including errors).
+
+        """
+        # other whitespace is an ordinary character in AMR.parse_AMR_line
+        if not line.isprintable():
+            return None
+        tokens = line.replace("(", " ( ").replace(")", " ) ").replace("/", " / ").replace(":", " :").split()
+        token_num = len(tokens)
+        node_name_list = []
+        node_index = {}
+        node_values = []
+        # relations of every node as (relation name, target node index), in the order of AMR.parse_AMR_line
+        relations = []
+        # (relation name, value) of every node, resolved to a relation or an attribute when all nodes are known
+        unresolved = []
+        # indices of open nodes
+        stack = []
+        cur_relation_name = ""
+        # (relation name, value) waiting for ":" or ")", which are handled differently
+        pending = None
+        k = 0
+        while k < token_num:
+            token = tokens[k]
+            c = token[0]
+            if c == "(":
+                # "(" name "/" concept
+                if pending is not None or (node_name_list and not cur_relation_name) or k + 3 >= token_num:
+                    return None
+                node_name = tokens[k + 1]
+                node_value = tokens[k + 3]
+                if (tokens[k + 2] != "/" or node_name[0] in "():/" or node_value[0] in "():/"
+                        or "\"" in node_name or "\"" in node_value or node_name in node_index):
+                    return None
+                i = len(node_name_list)
+                node_index[node_name] = i
+                node_name_list.append(node_name)
+                node_values.append(node_value)
+                relations.append([])
+                unresolved.append(None)
+                if cur_relation_name != "":
+                    if not cur_relation_name.endswith("-of"):
+                        relations[stack[-1]].append((cur_relation_name, i))
+                    else:
+                        relations[i].append((cur_relation_name[:-3], stack[-1]))
+                    cur_relation_name = ""
+                stack.append(i)
+                k += 4
+            elif c == ":":
+                if len(token) == 1 or "\"" in token or not stack or k + 1 >= token_num:
+                    return None
+                if pending is not None:
+                    # value before ":", "-of" is not reversed here
+                    target = node_index.get(pending[1])
+                    if target is not None:
+                        relations[stack[-1]].append((pending[0], target))
+                    elif unresolved[stack[-1]] is None:
+                        unresolved[stack[-1]] = [pending]
+                    else:
+                        unresolved[stack[-1]].append(pending)
+                    pending = None
+                relation_name = token[1:]
+                value = tokens[k + 1]
+                if value == "(":
+                    cur_relation_name = relation_name
+                    k += 1
+                    continue
+                if value[0] == "\"":
+                    # quotes are dropped and the closing one leaves "_"
+                    if len(value) < 2 or value[-1] != "\"" or "\"" in value[1:-1]:
+                        return None
+                    value = value[1:-1] + "_"
+                elif value[0] in "():/" or "\"" in value:
+                    return None
+                pending = (relation_name, value)
+                k += 2
+            elif c == ")":
+                if not stack:
+                    return None
+                if pending is not None:
+                    relation_name, value = pending
+                    target = node_index.get(value)
+                    if relation_name.endswith("-of"):
+                        # reverse relation of a node not seen yet
+                        if target is None:
+                            return None
+                        relations[target].append((relation_name[:-3], stack[-1]))
+                    elif target is not None:
+                        relations[stack[-1]].append((relation_name, target))
+                    elif unresolved[stack[-1]] is None:
+                        unresolved[stack[-1]] = [pending]
+                    else:
+                        unresolved[stack[-1]].append(pending)
+                    pending = None
+                stack.pop()
+                k += 1
+            else:
+                return None
+        if stack or not node_name_list:
+            return None
+
+        ids = SYMBOLS.ids
+        intern = SYMBOLS.intern
+        edge_source, edge_target, edge_label = [], [], []
+        attribute_node, attribute_label, attribute_value = [], [], []
+        for i, node_relations in enumerate(relations):
+            node_unresolved = unresolved[i]
+            if i and node_unresolved is None and len(node_relations) < 2:
+                # most nodes: at most one relation and no attributes
+                if node_relations:
+                    relation_name, target = node_relations[0]
+                    edge_source.append(i)
+                    edge_target.append(target)
+                    edge_label.append(ids[relation_name] if relation_name in ids else intern(relation_name))
+                continue
+            relation_dict = {target: relation_name for relation_name, target in node_relations}
+            attribute_dict = {}
+            if node_unresolved is not None:
+                for relation_name, value in node_unresolved:
+                    target = node_index.get(value)
+                    if target is not None:
+                        relation_dict[target] = relation_name
+                    else:
+                        attribute_dict[relation_name] = value
+            if i == 0:
+                # add TOP as an attribute. The attribute value is the top node value
+                attribute_dict["TOP"] = node_values[0]
+            for target, relation_name in relation_dict.items():
+                edge_source.append(i)
+                edge_target.append(target)
+                edge_label.append(ids[relation_name] if relation_name in ids else intern(relation_name))
+            for attribute_name, value in attribute_dict.items():
+                attribute_node.append(i)
+                attribute_label.append(ids[attribute_name] if attribute_name in ids else intern(attribute_name))
+                attribute_value.append(ids[value] if value in ids else intern(value))
+        result_amr = CompactAMR(node_name_list)
+        result_amr.concepts = array('i', [ids[value] if value in ids else intern(value) for value in node_values])
+        result_amr.edge_source = array('i', edge_source)
+        result_amr.edge_target = array('i', edge_target)
+        result_amr.edge_label = array('i', edge_label)
+        result_amr.attribute_node = array('i', attribute_node)
+        result_amr.attribute_label = array('i', attribute_label)
+        result_amr.attribute_value = array('i', attribute_value)
+        return result_amr
+
+    @staticmethod
+    def from_amr(amr_graph):
+        """
+        Convert an AMR object to CompactAMR with the same triples in the same order.
+
+        """
+        ids = SYMBOLS.ids
+        intern = SYMBOLS.intern
+        node_index = {node_name: i for i, node_name in enumerate(amr_graph.nodes)}
+        edge_source, edge_target, edge_label = [], [], []
+        attribute_node, attribute_label, attribute_value = [], [], []
+        for i, (relation_dict, attribute_dict) in enumerate(zip(amr_graph.relations, amr_graph.attributes)):
+            for target, relation_name in relation_dict.items():
+                edge_source.append(i)
+                edge_target.append(node_index[target])
+                edge_label.append(ids[relation_name] if relation_name in ids else intern(relation_name))
+            for attribute_name, value in attribute_dict.items():
+                attribute_node.append(i)
+                attribute_label.append(ids[attribute_name] if attribute_name in ids else intern(attribute_name))
+                attribute_value.append(ids[value] if value in ids else intern(value))
+        result_amr = CompactAMR(amr_graph.nodes[:])
+        result_amr.concepts = array('i', [ids[value] if value in ids else intern(value)
+                                          for value in amr_graph.node_values])
+        result_amr.edge_source = array('i', edge_source)
+        result_amr.edge_target = array('i', edge_target)
+        result_amr.edge_label = array('i', edge_label)
+        result_amr.attribute_node = array('i', attribute_node)
+        result_amr.attribute_label = array('i', attribute_label)
+        result_amr.attribute_value = array('i', attribute_value)
+        return result_amr
+
+# process-wide cache of parse_AMR_line_cached, None if disabled
+_parse_cache = LRUCache(PARSE_CACHE_SIZE)
+_not_cached = object()
+
+
+def parse_AMR_line_cached(line):
+    """
+    CompactAMR.parse_AMR_line with a process-wide LRU cache keyed by the exact line
+    (lines which can not be parsed are cached as None).
+    The returned graph is shared by all callers, so it must not be modified:
+    use get_triples with prefix instead of rename_node.
+
+    """
+    if _parse_cache is None:
+        return CompactAMR.parse_AMR_line(line)
+    result_amr = _parse_cache.get(line, _not_cached)
+    if result_amr is _not_cached:
+        result_amr = CompactAMR.parse_AMR_line(line)
+        _parse_cache.put(line, result_amr)
+    return result_amr
+
+
+def set_parse_cache_size(max_size):
+    """
+    Replace the parse cache by an empty one of max_size lines, 0 disables caching.
+
+    """
+    global _parse_cache
+    _parse_cache = LRUCache(max_size) if max_size > 0 else None
+
+
+def parse_cache_info():
+    """
+    Parse cache statistics (hits, misses, size and max size, see LRUCache.info) or None if it is disabled.
+
+    """
+    return _parse_cache.info() if _parse_cache is not None else None
+
+
+def trim_symbols(max_symbols=None):
+    """
+    Reset the symbol table if it has more than max_symbols (None for MAX_SYMBOLS) symbols, so it does not
+    grow with every label the process has ever seen. The parse cache is cleared with it, as its graphs refer
+    to the old ids.
+    CompactAMR graphs (and indices built from them) of the old generation are invalid afterwards,
+    so call it only when none of them are in use (smatch does before scoring AMR pairs, amr_utils.valid_amr
+    before every check). Not called by parse_AMR_line_cached, whose callers may hold graphs parsed before.
+    Returns True if the table was reset.
+
+    """
+    if len(SYMBOLS) <= (MAX_SYMBOLS if max_symbols is None else max_symbols):
+        return False
+    SYMBOLS.clear()
+    if _parse_cache is not None:
+        _parse_cache.clear()
+    return True
+
+
 # test AMR parsing
 # a unittest can also be used.
 if __name__ == "__main__":
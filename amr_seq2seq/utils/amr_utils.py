@@ -89,8 +89,11 @@ def valid_amr(amr_text):
     if not countparens(amr_text):  ## wrong parentheses, return false
         return False
 
+    # postprocessing keeps no parsed graphs, so the symbol table can be reset here (see amr.trim_symbols),
+    # in processes which never score AMRs it would grow with every label otherwise
+    amr.trim_symbols()
     try:
-        theamr = amr.AMR.parse_AMR_line(amr_text)
+        theamr = amr.parse_AMR_line_cached(amr_text)
         if theamr is None:
             return False
             logger.error(f"MAJOR WARNING: couldn't build amr out of {amr_text} using smatch code")
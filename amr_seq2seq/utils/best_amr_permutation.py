@@ -42,6 +42,8 @@ def create_arg_parser():
                         help="AMR extension (default .txt) - should have alignments")
     parser.add_argument("-cut_off", default=15, type=int, help="When to cut-off number of permutations")
     parser.add_argument("-double", action='store_true', help="Add best permutation AMR AND normal AMR?")
+    parser.add_argument("-max_depth", default=None, type=int,
+                        help="Deepest level that is permuted (default: no limit, 12 for the old behaviour)")
     args = parser.parse_args()
 
     return args
@@ -205,7 +207,7 @@ def matching_words(permutations):
     for per in permutations:
         found_words = find_words(per)
         if found_words:
-            all_found.append(find_words(per))
+            all_found.append(found_words)
 
     return all_found
 
@@ -278,34 +280,33 @@ def filter_colons(part):
 def get_add_string(search_part):
     """Get the initial permutations and add_string"""
 
-    paren_count = 0
-    start_adding = False
+    # a permutation ends with the parenthesis that closes all parentheses opened since the start,
+    # characters before the first ':' are not added
     permutations = []
-    add_string = ''
-
-    for idx, ch in enumerate(search_part):
-        if ch == '(':  # parenthesis found
-            if start_adding:
-                add_string += ch
+    start = search_part.find(':')
+    if start < 0:
+        start = len(search_part) + 1
+    paren_count = 0
+    for match in re.finditer(r'[()]', search_part):
+        if match.group() == '(':
             paren_count += 1
-        elif ch == ':':
-            start_adding = True
-            add_string += ch
-        elif ch == ')':
-            paren_count -= 1
-            if start_adding:
-                add_string += ch
-            if paren_count == 0:  # we closed one of the permutations now
-                permutations.append(add_string.strip())
-                add_string = ''
-        elif start_adding:
-            add_string += ch
+            continue
+        paren_count -= 1
+        if paren_count == 0:  # we closed one of the permutations now
+            end = match.end()
+            if end > start:
+                permutations.append(search_part[start:end].strip())
+                start = end
+            else:
+                permutations.append('')
+    add_string = search_part[start:]
 
     if add_string and ':' in add_string:
         permutations.append(add_string.replace(')', '').strip())
         for idx, p in enumerate(permutations):
-            while permutations[idx].count(')') < permutations[idx].count('('):
-                permutations[idx] += ')'
+            balance = paren_balance(p)
+            if balance > 0:
+                permutations[idx] += ')' * balance
 
     # permutate without brackets (e.g. :op1 "hoi" :op2 "hai" :op3 "ok"
 
@@ -367,7 +368,6 @@ def get_permutations(part, level, sent_amr, all_perms, type_script, cut_off):
     add_string, permutations = get_add_string(search_part)
 
     permutations = combine_permutations(permutations, cut_off)
-    word_list = matching_words(permutations)  # find the list of lists that contain word-sense pairs
 
     # Two possibilities here, ordering or pruning. This script only does ordering, delete_double_args.py does pruning and uses this function.
 
@@ -385,6 +385,7 @@ def get_permutations(part, level, sent_amr, all_perms, type_script, cut_off):
         return permutations_set, keep_string, all_perms
 
     else:
+        word_list = matching_words(permutations)  # find the list of lists that contain word-sense pairs
         if len(word_list) != len(
                 permutations):  # something strange is going on here, just ignore it and do nothing to avoid errors
             print('Strange AMR part')
@@ -430,85 +431,54 @@ def fix_paren(string):
     return string
 
 
-def get_best_perm(permutations, keep_str, sent, final_string, all_perms, type_script, cut_off):
-    """This must also be possible recursive - I tried..."""
-
-    for indx2, p2 in enumerate(permutations):
-        permutations_2, keep_string2, all_perms = get_permutations(p2, 2, sent, all_perms, type_script, cut_off)
-
-        for indx3, p3 in enumerate(permutations_2):
-            permutations_3, keep_string3, all_perms = get_permutations(p3, 3, sent, all_perms, type_script, cut_off)
-
-            for indx4, p4 in enumerate(permutations_3):
-                permutations_4, keep_string4, all_perms = get_permutations(p4, 4, sent, all_perms, type_script, cut_off)
-
-                for indx5, p5 in enumerate(permutations_4):
-                    permutations_5, keep_string5, all_perms = get_permutations(p5, 5, sent, all_perms, type_script,
-                                                                               cut_off)
-
-                    for indx6, p6 in enumerate(permutations_5):
-                        permutations_6, keep_string6, all_perms = get_permutations(p6, 6, sent, all_perms, type_script,
-                                                                                   cut_off)
-
-                        for indx7, p7 in enumerate(permutations_6):
-                            permutations_7, keep_string7, all_perms = get_permutations(p7, 7, sent, all_perms,
-                                                                                       type_script, cut_off)
-
-                            for indx8, p8 in enumerate(permutations_7):
-                                permutations_8, keep_string8, all_perms = get_permutations(p8, 8, sent, all_perms,
-                                                                                           type_script, cut_off)
-
-                                for indx9, p9 in enumerate(permutations_8):
-                                    permutations_9, keep_string9, all_perms = get_permutations(p9, 9, sent, all_perms,
-                                                                                               type_script, cut_off)
-
-                                    for indx10, p10 in enumerate(permutations_9):
-                                        permutations_10, keep_string10, all_perms = get_permutations(p10, 10, sent,
-                                                                                                     all_perms,
-                                                                                                     type_script,
-                                                                                                     cut_off)
-
-                                        for indx11, p11 in enumerate(permutations_10):
-                                            permutations_11, keep_string11, all_perms = get_permutations(p11, 11, sent,
-                                                                                                         all_perms,
-                                                                                                         type_script,
-                                                                                                         cut_off)
-
-                                            for indx12, p12 in enumerate(permutations_11):
-                                                permutations_12, keep_string12, all_perms = get_permutations(p12, 12,
-                                                                                                             sent,
-                                                                                                             all_perms,
-                                                                                                             type_script,
-                                                                                                             cut_off)
-                                                add_string = do_string_adjustments(permutations_12, keep_string12)
-                                                keep_string11 += add_string.replace('  ', ' ')
-
-                                            keep_string10 += fix_paren(keep_string11)
-
-                                        keep_string9 += fix_paren(keep_string10)
-
-                                    keep_string8 += fix_paren(keep_string9)
-
-                                keep_string7 += fix_paren(keep_string8)
-
-                            keep_string6 += fix_paren(keep_string7)
-
-                        keep_string5 += fix_paren(keep_string6)
-
-                    keep_string4 += fix_paren(keep_string5)
-
-                keep_string3 += fix_paren(keep_string4)
-
-            keep_string2 += fix_paren(keep_string3)
-
-        final_string += fix_paren(keep_string2)
-
-    final_string = fix_paren(final_string)
+def paren_balance(string):
+    """Number of opening minus number of closing parentheses"""
+    return string.count('(') - string.count(')')
+
+
+def get_best_perm(permutations, keep_str, sent, final_string, all_perms, type_script, cut_off, max_depth=None):
+    """Permute (or prune) the parts of an AMR at every level and join them back to a line.
+       final_string is the kept start of the AMR (level 1) and permutations are its level 2 parts.
+       Levels are processed depth-first with an explicit stack, every level joins the strings of its
+       parts and closes its open parentheses (as fix_paren does). Parts that can not be changed anymore end
+       the descent, parts at level max_depth are added without permuting them (max_depth=12 gives exactly
+       the output of the original 12 nested loops, see benchmarks/permutation.py)."""
+
+    # every frame: [strings of the level, parenthesis balance of the strings, remaining parts, level]
+    stack = [[[final_string], paren_balance(final_string), iter(permutations), 1]]
+    while True:
+        frame = stack[-1]
+        part = next(frame[2], None)
+        if part is None:
+            # all parts done, close the level and add it to the level above
+            stack.pop()
+            strings, balance = frame[0], frame[1]
+            if balance > 0:
+                strings.append(')' * balance)
+                balance = 0
+            if not stack:
+                return ''.join(strings)
+            stack[-1][0].append(''.join(strings))
+            stack[-1][1] += balance
+            continue
 
-    return final_string
+        level = frame[3] + 1
+        permutations_new, keep_string, all_perms = get_permutations(part, level, sent, all_perms, type_script,
+                                                                    cut_off)
+        if level == max_depth or not keep_string:
+            # deepest level or nothing to permute (deeper levels would return the same), as do_string_adjustments
+            add_string = keep_string + ' ' + ' '.join(permutations_new) + ' '
+            balance = paren_balance(add_string)
+            if balance > 0:
+                add_string += ')' * balance
+                balance = 0
+            frame[0].append(add_string.replace('  ', ' '))
+            frame[1] += balance
+        else:
+            stack.append([[keep_string], paren_balance(keep_string), iter(permutations_new), level])
 
 
-def process_file_best(amrs, sent_amrs, cut_off):
+def process_file_best(amrs, sent_amrs, cut_off, max_depth=None):
     """Permute AMR so that it best matches the word order"""
 
     save_all_amrs = []
@@ -519,7 +489,7 @@ def process_file_best(amrs, sent_amrs, cut_off):
         if amr.count(':') > 1:  ## only try to do something if we can actually permutate
             permutations, keep_string1, _ = get_permutations(amr, 1, sent_amrs[idx], [], 'order', cut_off)
             final_string = get_best_perm(permutations, '(' + keep_string1, sent_amrs[idx], '(' + keep_string1, [],
-                                         'order', cut_off)
+                                         'order', cut_off, max_depth)
             save_all_amrs.append(create_final_line(final_string))  ## add final string + final parenthesis
         else:
             save_all_amrs.append(remove_alignment(amr))  ## else just add AMR without alignment information
@@ -575,6 +545,6 @@ if __name__ == '__main__':
     print('Processing {0}'.format(args.f))
 
     sent_amrs, old_amrs = preprocess(args.f)
-    new_amrs, old_amrs = process_file_best(old_amrs, sent_amrs, args.cut_off)
+    new_amrs, old_amrs = process_file_best(old_amrs, sent_amrs, args.cut_off, args.max_depth)
 
     create_output(args.f, old_amrs, new_amrs, sent_amrs)
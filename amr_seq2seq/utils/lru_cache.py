@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Bounded least-recently-used cache with hit/miss counters"""
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Dictionary-like cache holding at most max_size items and, if max_bytes is given,
+    items of at most max_bytes estimated bytes (size_of gives the estimate of a value).
+    When the cache is full, the least recently used items are evicted.
+    Counts hits and misses of get() calls, so the cache can be sized.
+
+    """
+
+    def __init__(self, max_size, max_bytes=None, size_of=None):
+        if max_size < 1:
+            raise ValueError("LRUCache size should be positive, got {0}".format(max_size))
+        if max_bytes is not None and (max_bytes < 1 or size_of is None):
+            raise ValueError("LRUCache memory limit should be positive and needs size_of, got {0}".format(max_bytes))
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        # estimated size of every item, only with a memory limit
+        self._sizes = {}
+
+    def get(self, key, default=None):
+        """
+        Return the cached value (and mark it as recently used) or default if the key is not cached.
+
+        """
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Cache the value, evicting the least recently used items if the cache is full.
+        The last put value is kept even if it alone exceeds the memory limit.
+
+        """
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if self.max_bytes is not None:
+            size = self.size_of(value)
+            self.bytes += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+        while len(self._items) > self.max_size or (self.max_bytes is not None and self.bytes > self.max_bytes
+                                                   and len(self._items) > 1):
+            evicted, _ = self._items.popitem(last=False)
+            if self.max_bytes is not None:
+                self.bytes -= self._sizes.pop(evicted)
+
+    def clear(self):
+        self._items.clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+    def info(self):
+        """
+        Cache statistics: hits, misses, current size and max size
+        (with a memory limit also estimated bytes and max bytes).
+
+        """
+        info = {'hits': self.hits, 'misses': self.misses, 'size': len(self._items), 'max_size': self.max_size}
+        if self.max_bytes is not None:
+            info['bytes'] = self.bytes
+            info['max_bytes'] = self.max_bytes
+        return info
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
@@ -52,7 +52,7 @@ def restore_variables_item(item):
     # os.system(f'rm {f}.pruned_temp')  # remove temp file again
 
 
-def prune_item(line, cut_off=15):
+def prune_item(line, cut_off=15, max_depth=None):
     clean_line = re.sub(r'\([A-Za-z0-9-_~]+ / ', r'(', line).strip()  # delete variables
 
     if clean_line.count(':') > 1:  # only try to do something if we can actually permutate
@@ -61,7 +61,7 @@ def prune_item(line, cut_off=15):
                                                                  cut_off)  # get initial permutations
         keep_str = '(' + keep_string1
         final_string = get_best_perm(permutations, keep_str, '', keep_str, all_perms, 'prune',
-                                     cut_off)  # prune duplicate output here
+                                     cut_off, max_depth)  # prune duplicate output here
 
         add_to = " ".join(create_final_line(final_string).split())  # create final AMR line
         clean_line = " ".join(clean_line.split())
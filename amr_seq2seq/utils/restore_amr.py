@@ -40,6 +40,15 @@ misplaced_colon = re.compile(r':(?=\))')
 missing_concept_and_variable = re.compile(r'(?<=\()\s*(?=:\w+)')
 dangling_quotes = re.compile(r'(?<=\s)(\w+)"(?=\s|\)|:)')
 
+# tokens of convert and do_extra_steps
+parens = re.compile(r'[()]')
+name_values = re.compile(r'(:op\d+|:wiki) ([^\-_():"][^():"]*)(?=[:\)])')
+relation_values = re.compile(r'(:\w+) ([^\W\d\-][\w\-]*)(?=\W)')
+quoted_relations = re.compile(r':(op\d+|value|time|li|mod|timezone|era)"')
+# numbers glued to relations, e.g. op123.5 (op1 23.5), op12.5 (op1 2.5), mod12.5 (mod1 2.5)
+glued_numbers = re.compile(r'(op\d)(\d\d+)|(op\d|mod\d|ARG\d)(\d+)\.(\d+)')
+quoted_ops = set('op' + str(x) for x in range(0, 25))
+
 
 # def create_arg_parser():
 #     parser = argparse.ArgumentParser()
@@ -108,6 +117,7 @@ class ReplaceVar:
     def __init__(self, c, cc):
         self.c = c
         self.cc = cc
+        self.seen = set(cc)
 
     def replace_var(self, m):
         # global c
@@ -119,7 +129,8 @@ class ReplaceVar:
         if ['name', 'date'].count(m.group(1)) == 1:
             self.c += 1
             return '(v' + str(ggg) + str(self.c) + ' / ' + m.group(1) + m.group(2)
-        if self.cc.count(m.group(1)) == 0:
+        if m.group(1) not in self.seen:
+            self.seen.add(m.group(1))
             self.cc.append(m.group(1))
             return '(vv' + str(ggg) + m.group(1) + ' / ' + m.group(1) + m.group(2)
         if m.group(2) == ' )':
@@ -146,82 +157,118 @@ def add_quotes(m):
     return '%s "%s" ' % (m.group(1), value)
 
 
+def fix_malformed_parts(line):
+    """Last steps of convert, fix parts of the line that can not be parsed.
+       A fixed chain of regular expression passes (no loop until the line does not change),
+       each pass sees the result of the previous ones."""
+    line = unbracket.sub(r'\1', line, re.U)
+
+    line = dangling_edges.sub('', line, re.U)
+
+    line = missing_edges.sub(r'\1 :ARG2 (', line, re.U)
+
+    line = missing_variable.sub(r'vvvx / \1 ', line, re.U)
+
+    line = missing_quotes.sub(r'\1"', line, re.U)
+
+    line = misplaced_colon.sub(r'', line, re.U)
+
+    line = missing_concept_and_variable.sub(r'd / dummy ', line, re.U)
+
+    line = dangling_quotes.sub(r'\1', line, re.U)
+
+    return line
+
+
 def convert(line):
+    """Restore variables and fix the line, every step is a single pass over the line.
+       The original version (kept in benchmarks/restore_amr.py) repeats substitutions limited to 2 replacements
+       (re.I is passed as count) until the line does not change, here the final result of each loop is computed
+       directly:
+       - every name :opN value and :wiki value is quoted, quoting one value does not change the others
+       - values of relations are quoted up to the second :mode keyword (interrogative, expressive, imperative),
+         a pass replacing only keywords leaves the line unchanged and ends the loop
+       Parentheses are counted once and only updated by the added or removed ones.
+       The remaining fixes (fix_malformed_parts) stay a fixed chain of regular expression passes."""
     line = line.rstrip().lstrip(' \xef\xbb\xbf\ufeff')
     line = line.rstrip().lstrip('> ')
 
-    # global cc
-    # global c
-    # global ggg
-    ggg = 99999
-
     replacer = ReplaceVar(c=0, cc=[])
-    old_line = line
 
-    while True:
-        line = re.sub(r'(\( ?name [^()]*:op\d+|:wiki) ([^\-_():"][^():"]*)(?=[:\)])', add_quotes, line, re.I)
-        if old_line == line:
-            break
-        old_line = line
+    # quote values, :opN only inside a name node (after "(name " or "( name " without other parentheses)
+    parts = []
+    start = 0
+    last_paren = -1
+    searched = 0
+    for m in name_values.finditer(line):
+        # last parenthesis before the value, values do not contain parentheses
+        last_paren = max(last_paren, line.rfind('(', searched, m.start()), line.rfind(')', searched, m.start()))
+        searched = m.start()
+        if m.group(1) != ':wiki' and (last_paren < 0 or line[last_paren] != '('
+                                      or not line.startswith(('(name ', '( name '), last_paren)):
+            continue
+        parts.append(line[start:m.start()])
+        parts.append(add_quotes(m))
+        start = m.end()
+    parts.append(line[start:])
+    line = ''.join(parts)
 
     line = re.sub(r'\(\s*([\w\-\d]+)(\W.|\))', replacer.replace_var, line)
 
     line = re.sub(r'"(_[^"]+)"', lambda m: restore(m.group(1)), line)
 
+    # cut the line before the parenthesis that closes all parentheses opened so far
     open_count = 0
     close_count = 0
-
-    for i, c in enumerate(line):
-        if c == '(':
+    for m in parens.finditer(line):
+        if m.group() == '(':
             open_count += 1
-        elif c == ')':
+        else:
             close_count += 1
-        if open_count == close_count and open_count > 0:
-            line = line[:i].strip()
+        if open_count == close_count:
+            line = line[:m.start()].strip()
             break
+    open_count = line.count('(')
+    close_count = line.count(')')
 
-    old_line = line
-
+    # add missing closing parentheses or remove extra ones from the end
     while True:
-        open_count = len(re.findall(r'\(', line))
-        close_count = len(re.findall(r'\)', line))
         if open_count > close_count:
             line += ')' * (open_count - close_count)
-        elif close_count > open_count:
-            before = line
-            for i in range(close_count - open_count):
-                line = line.rstrip(')')
-                line = line.rstrip(' ')
-
-        if old_line == line:
+            close_count = open_count
+            continue
+        end = len(line)
+        for _ in range(close_count - open_count):
+            before = end
+            while end and line[end - 1] == ')':
+                end -= 1
+                close_count -= 1
+            while end and line[end - 1] == ' ':
+                end -= 1
+            if end == before:
+                break
+        if end == len(line):
             break
-        old_line = line
-
-    old_line = line
-
-    while True:
-        line = re.sub(r'(:\w+) ([^\W\d\-][\w\-]*)(?=\W)', replacer.replace_var2, line, re.I)
-        if old_line == line:
-            break
-        old_line = line
-
-    line = unbracket.sub(r'\1', line, re.U)
-
-    line = dangling_edges.sub('', line, re.U)
-
-    line = missing_edges.sub(r'\1 :ARG2 (', line, re.U)
-
-    line = missing_variable.sub(r'vvvx / \1 ', line, re.U)
-
-    line = missing_quotes.sub(r'\1"', line, re.U)
-
-    line = misplaced_colon.sub(r'', line, re.U)
-
-    line = missing_concept_and_variable.sub(r'd / dummy ', line, re.U)
-
-    line = dangling_quotes.sub(r'\1', line, re.U)
-
-    return line
+        line = line[:end]
+
+    # quote values of relations
+    parts = []
+    start = 0
+    keywords = 0
+    for m in relation_values.finditer(line):
+        replaced = replacer.replace_var2(m)
+        if replaced == m.group():
+            keywords += 1
+            if keywords == 2:
+                break
+            continue
+        parts.append(line[start:m.start()])
+        parts.append(replaced)
+        start = m.end()
+    parts.append(line[start:])
+    line = ''.join(parts)
+
+    return fix_malformed_parts(line)
 
 
 def add_space_when_digit(line):
@@ -251,40 +298,36 @@ def add_space_when_digit(line):
     return ':'.join(spl)
 
 
+def split_numbers(line):
+    """Last steps of do_extra_steps, separate numbers from relations in a single substitution
+       (the original four substitutions never match text produced by each other)"""
+    line = glued_numbers.sub(lambda m: (m.group(1) + ' ' + m.group(2) if m.group(1)
+                                        else m.group(3) + ' ' + m.group(4) + '.' + m.group(5)), line)
+    line = line.replace(':polarity 100', ':polarity -')
+    return line
+
+
 def do_extra_steps(line):
+    """Separate relations, quotes and numbers, quotes are separated by a single substitution and a single split
+       (the original version, kept in benchmarks/restore_amr.py, walks the line character by character)"""
     line = line.replace(':', ' :')  # colon has no spaces
     line = line.replace('(', ' (')
-    for x in range(0, 25):  # change :op0"value" to :op0 "value" as to avoid errors
-        line = line.replace(':op' + str(x) + '"', ':op' + str(x) + ' "')
-
-    line = line.replace(':value"', ':value "')
-    line = line.replace(':time"', ':time "')
-    line = line.replace(':li"', ':li "')
-    line = line.replace(':mod"', ':mod "')
-    line = line.replace(':timezone"', ':timezone "')
-    line = line.replace(':era"', ':era "')
-
-    quotes = 0
-    prev_char = 'a'
-    new_line = ''
-
-    for ch in line:
-        if ch == '"':
-            quotes += 1
-            if quotes % 2 != 0 and (new_line == '' or new_line[-1] != ' '):
-                new_line += ' "'  # add space for quote
-            else:
-                new_line += ch
+    # change :op0"value" to :op0 "value" (op0 to op24) and the same for some other relations
+    line = quoted_relations.sub(lambda m: m.group() if m.group(1).startswith('op') and m.group(1) not in quoted_ops
+                                else ':' + m.group(1) + ' "', line)
+
+    # add a space before every opening quote that does not follow a space
+    parts = line.split('"')
+    new_parts = [parts[0]]
+    for k in range(1, len(parts)):
+        if k % 2:
+            previous = parts[k - 1][-1:] if parts[k - 1] or k == 1 else '"'
+            new_parts.append(' "' if previous != ' ' else '"')
         else:
-            new_line += ch
-
-    new_line = re.sub('(op\d)(\d\d+)', r'\1 \2',
-                      new_line)  # fix problem with op and numbers, e.g. change op123.5 to op1 23.5
-    new_line = re.sub(r'(op\d)(\d+)\.(\d+)', r'\1 \2.\3', new_line)
-    new_line = re.sub(r'(mod\d)(\d+)\.(\d+)', r'\1 \2.\3', new_line)
-    new_line = re.sub(r'(ARG\d)(\d+)\.(\d+)', r'\1 \2.\3', new_line)
-    new_line = new_line.replace(':polarity 100', ':polarity -')
-    return new_line
+            new_parts.append('"')
+        new_parts.append(parts[k])
+
+    return split_numbers(''.join(new_parts))
 
 
 ### Function to process AMRs that used the Indexing method to solve coreference ###				
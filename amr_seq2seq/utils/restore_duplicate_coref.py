@@ -2,7 +2,8 @@ import re
 
 import logging
 
-from .amr_utils import valid_amr
+from . import amr
+from .amr_utils import countparens
 
 logger = logging.getLogger('amr_postprocessing')
 
@@ -60,21 +61,200 @@ def process_var_line(line):
     return var_list
 
 
+# tokens of canonical restored lines (see parse_restored_line), other lines use the replacement loop
+variable_token = re.compile(r'[\w\-]+')
+concept_token = re.compile(r'[^\s()/:"]+')
+constant_token = re.compile(r'[^\s()/:"]+|"[^\s()/:"]*"')
+
+
+class AMRTreeNode(object):
+    """
+    Node of a restored AMR, kept together with the tokens of the line it was parsed from:
+    variable: variable of the node
+    parent: parent AMRTreeNode (None for the root)
+    child_num: number of child nodes (not replaced by references)
+    start, concept: indices of the "(var" token and of the concept token
+    end: index of the token holding the closing parenthesis of the node
+
+    """
+    __slots__ = ('variable', 'parent', 'child_num', 'start', 'concept', 'end')
+
+    def __init__(self, variable, parent, start):
+        self.variable = variable
+        self.parent = parent
+        self.child_num = 0
+        self.start = start
+        self.concept = start + 2
+        self.end = None
+
+
+def parse_restored_line(line):
+    """
+    Parse a line in canonical one-line form: "(var / concept :rel value ...)" with single spaces, unique variables
+    and no special characters ("(", ")", "/", ":" and quotes) inside tokens other than quoted constants.
+    Returns the list of its tokens and the list of its nodes (AMRTreeNode) in line order,
+    or None if the line is not in canonical form.
+
+    """
+    tokens = line.split(' ')
+    nodes = []
+    variables = set()
+    stack = []
+    relation = None
+    i = 0
+    token_num = len(tokens)
+    while i < token_num:
+        token = tokens[i]
+        value = token.rstrip(')')
+        if token and not value:
+            # closing parentheses separated by a space, e.g. after an added quote
+            if relation is not None:
+                return None
+        elif relation is None and stack:
+            # relation of the node on top of the stack
+            if token[:1] != ':' or not concept_token.fullmatch(token, 1):
+                return None
+            relation = token
+            i += 1
+            continue
+        elif token[:1] == '(':
+            # new node: "(var", "/", "concept)))"
+            variable = token[1:]
+            if (i + 2 >= token_num or tokens[i + 1] != '/' or not variable_token.fullmatch(variable)
+                    or variable in variables or (nodes and not stack)):
+                return None
+            variables.add(variable)
+            i += 2
+            value = tokens[i].rstrip(')')
+            if not concept_token.fullmatch(value):
+                return None
+            node = AMRTreeNode(variable, stack[-1] if stack else None, i - 2)
+            if stack:
+                stack[-1].child_num += 1
+            stack.append(node)
+            nodes.append(node)
+        else:
+            # constant or reference
+            if not stack or not constant_token.fullmatch(value):
+                return None
+        relation = None
+        close_num = len(tokens[i]) - len(value)
+        if close_num > len(stack):
+            return None
+        for _ in range(close_num):
+            stack.pop().end = i
+        i += 1
+    if not nodes or stack or relation is not None:
+        return None
+    return tokens, nodes
+
+
+def restore_coreference(tokens, nodes, line):
+    """
+    Replace duplicate nodes of a canonical line (see parse_restored_line) by references in one pass.
+    Every canonical AMR, with or without duplicate nodes replaced by references, is valid for the smatch parser,
+    so the replacement loop of process_item would keep every replacement it tries, which this pass reproduces
+    without any validity parse. Nodes are compared by the text following their "/" up to the next node
+    (process_var_line extracts it from the line), a duplicate is replaced by the first earlier node with
+    the same text, as soon as it has no child nodes left. Returns the resulting line.
+
+    """
+    # process_var_line skips the root
+    entries = nodes[1:] if len(nodes) > 1 else nodes
+    values = []
+    for k, node in enumerate(entries):
+        end = entries[k + 1].start if k + 1 < len(entries) else len(tokens)
+        # the same text as process_var_line: parentheses removed, the last word dropped unless it is a number
+        value = ' '.join(tokens[node.concept:end]).replace(')', '')
+        words = value.split()
+        if len(words) > 1 and not words[-1].isdigit():
+            value = ' '.join(words[:-1])
+        values.append(value)
+
+    groups = {}
+    for k, value in enumerate(values):
+        groups.setdefault(value, []).append(k)
+    # duplicates that can be replaced, the first entry of a group never is, and the text has to occur in the line
+    candidates = {}
+    for value, group in groups.items():
+        if len(group) > 1:
+            candidates[value] = [y for y in group[1:] if entries[y].variable + ' / ' + value in line]
+
+    tokens = list(tokens)
+    for idx in range(len(entries) - 1):
+        waiting = candidates.get(values[idx])
+        if not waiting:
+            continue
+        # entries before idx can only be replaced by earlier entries, so they are dropped
+        still_waiting = []
+        for y in waiting:
+            if y <= idx:
+                continue
+            node = entries[y]
+            if node.child_num > 0:
+                still_waiting.append(y)
+                continue
+            # "(var / concept ...)" up to the first closing parenthesis is replaced by the variable of the first node
+            end = node.end
+            close_num = len(tokens[end]) - len(tokens[end].rstrip(')'))
+            tokens[node.start] = entries[idx].variable + ')' * (close_num - 1)
+            for k in range(node.start + 1, end + 1):
+                tokens[k] = None
+            # ancestors closed in the same token are now closed in the reference token
+            parent = node.parent
+            parent.child_num -= 1
+            while parent is not None and parent.end == end:
+                parent.end = node.start
+                parent = parent.parent
+        candidates[values[idx]] = still_waiting
+    return ' '.join(token for token in tokens if token is not None)
+
+
+def valid_candidate(line):
+    """valid_amr for throwaway candidate lines: parsed by AMR.parse_AMR_line, so they do not fill
+       the shared parse cache and the symbol table"""
+    if not countparens(line):
+        return False
+    try:
+        return amr.AMR.parse_AMR_line(line) is not None
+    except Exception as e:
+        logger.error(e)
+        return False
+
+
 def process_item(line):
     var_list = process_var_line(line)  # get list of variables and concepts
+
+    # concept -> indices of its entries in var_list, only repeated concepts can be replaced
+    concept_index = {}
+    for idx, (_, value) in enumerate(var_list):
+        concept_index.setdefault(value, []).append(idx)
+    if all(len(positions) < 2 for positions in concept_index.values()):
+        return line.strip()
+
+    parsed = parse_restored_line(line)
+    if parsed is not None:
+        # canonical line: every replacement gives a valid AMR, so all of them are done in one pass
+        tokens, nodes = parsed
+        return restore_coreference(tokens, nodes, line)
+
+    # any other line: replacements are tried one by one and kept only if the AMR stays valid
     new_line = line
+    patterns = {}
 
     for idx in range(len(var_list) - 1):
-        for y in range(idx + 1, len(var_list)):
-            if var_list[idx][1] == var_list[y][1]:  # match - we see a concept we already saw before
-                replace_item = var_list[y][0] + ' / ' + var_list[y][1]  # the part that needs to be replaced
-                if replace_item in line:
-
-                    new_line_replaced = re.sub(r'\({0} / [^\(]*?\)'.format(var_list[y][0]), var_list[idx][0],
-                                               new_line)  # coref matching, replace :ARG1 (var / value) by :ARG refvar
+        for y in concept_index[var_list[idx][1]]:  # match - we see a concept we already saw before
+            if y <= idx:
+                continue
+            replace_item = var_list[y][0] + ' / ' + var_list[y][1]  # the part that needs to be replaced
+            if replace_item in line:
+                if var_list[y][0] not in patterns:
+                    patterns[var_list[y][0]] = re.compile(r'\({0} / [^\(]*?\)'.format(var_list[y][0]))
+                new_line_replaced = patterns[var_list[y][0]].sub(var_list[idx][0],
+                                                                 new_line)  # coref matching, replace :ARG1 (var / value) by :ARG refvar
 
-                    if new_line_replaced != new_line:  # something changed
-                        if valid_amr(new_line_replaced):  # only replace if resulting AMR is valid
-                            new_line = new_line_replaced
+                if new_line_replaced != new_line:  # something changed
+                    if valid_candidate(new_line_replaced):  # only replace if resulting AMR is valid
+                        new_line = new_line_replaced
 
     return new_line.strip()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cache of smatch scores of AMR pairs.
+
+The same (prediction, gold) pairs are scored again and again: unchanged predictions of nearby checkpoints,
+repeated runs of the evaluation script on the same files, duplicated sentences. Scores are cached under
+a key built from hashes of both AMRs and the scoring settings (restart number, just-* flags, seed),
+so a repeated pair skips parsing and hill-climbing entirely.
+
+There are two tiers: an in-memory LRU cache and an optional SQLite file shared between runs.
+
+"""
+
+import sqlite3
+import hashlib
+import json
+
+try:
+    from .lru_cache import LRUCache
+except:
+    from lru_cache import LRUCache
+
+
+class PairScoreCache(object):
+    """
+    Two-tier cache of (match_num, test_num, gold_num) scores of AMR pairs.
+    Scores may be followed by more integers (e.g. fine-grained counts), they are kept in the extra column.
+
+    """
+
+    # number of writes to SQLite between commits
+    COMMIT_EVERY = 1000
+    # default size of the in-memory tier
+    MEMORY_SIZE = 100000
+
+    def __init__(self, max_size=MEMORY_SIZE, path=None):
+        """
+        max_size: size of the in-memory LRU tier (number of AMR pairs)
+        path: SQLite file of the on-disk tier (created if missing), None to keep scores only in memory
+
+        """
+        self.memory = LRUCache(max_size)
+        self.path = path
+        self._connection = None
+        self._pending = 0
+
+    @staticmethod
+    def make_key(cur_amr1, cur_amr2, settings):
+        """
+        Cache key of an AMR pair scored with the given settings (string, see SmatchScript.score_settings).
+
+        """
+        hash1 = hashlib.sha1(cur_amr1.encode('utf-8')).hexdigest()
+        hash2 = hashlib.sha1(cur_amr2.encode('utf-8')).hexdigest()
+        return "{0}:{1}:{2}".format(hash1, hash2, settings)
+
+    def get(self, key):
+        """
+        Return cached (match_num, test_num, gold_num, ...) or None.
+
+        """
+        scores = self.memory.get(key)
+        if scores is not None or self.path is None:
+            return scores
+        row = self._get_connection().execute(
+            "SELECT match_num, test_num, gold_num, extra FROM pair_scores WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        scores = tuple(row[:3])
+        if row[3] is not None:
+            scores += tuple(json.loads(row[3]))
+        self.memory.put(key, scores)
+        return scores
+
+    def put(self, key, scores):
+        """
+        Cache (match_num, test_num, gold_num, ...) of the pair.
+
+        """
+        scores = tuple(scores)
+        self.memory.put(key, scores)
+        if self.path is None:
+            return
+        extra = json.dumps(scores[3:]) if len(scores) > 3 else None
+        self._get_connection().execute(
+            "INSERT OR REPLACE INTO pair_scores (key, match_num, test_num, gold_num, extra) VALUES (?, ?, ?, ?, ?)",
+            (key,) + scores[:3] + (extra,))
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit pending writes of the on-disk tier.
+
+        """
+        if self._connection is not None and self._pending:
+            self._connection.commit()
+        self._pending = 0
+
+    def close(self):
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS pair_scores "
+                                     "(key TEXT PRIMARY KEY, match_num INTEGER, test_num INTEGER, gold_num INTEGER, "
+                                     "extra TEXT)")
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(pair_scores)")]
+            if 'extra' not in columns:
+                # cache file written before extra scores were supported
+                self._connection.execute("ALTER TABLE pair_scores ADD COLUMN extra TEXT")
+        return self._connection
+
+    def __getstate__(self):
+        # SQLite connection can not be pickled, it is reopened on demand
+        self.flush()
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
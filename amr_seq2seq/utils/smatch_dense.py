@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Dense NumPy engine for smatch hill-climbing.
+
+Instead of walking nested weight_dict dictionaries for every candidate move or swap, all candidate node pairs
+are enumerated once and stored in arrays:
+    weights: weights[q] is the instance/attribute triple match of candidate node pair q
+    relation weights: the relation triple match of node pairs q and r mapped together, in a dense p x p matrix
+                      for pools of at most DENSE_MAX_PAIRS pairs, otherwise sparse (only pairs sharing
+                      a relation have one, the matrix of a large AMR pair would take hundreds of MB):
+                      columns in compressed sparse form for the contribution updates and sorted flat keys
+                      q * (p + 1) + r for looking up the weights of given pairs
+The engine keeps a contribution vector (contribution[q] is the relation triple match of node pair q with all node
+pairs of the current mapping), so that the gain of every move and swap is computed by vectorized lookups
+and the vector is updated incrementally after each step.
+
+Move/swap enumeration order and tie-breaking are the same as in SmatchScript.get_best_gain,
+so for the same initial mappings this engine gives exactly the same results as the dictionary one.
+
+"""
+
+import numpy as np
+
+# largest candidate pool with a dense relation weight matrix (16 MB), larger pools use sparse weights,
+# which are about two times slower to look up
+DENSE_MAX_PAIRS = 2048
+
+
+class DenseMatchEngine(object):
+    """
+    Hill-climbing over the candidate pool of one AMR pair.
+    Memory is O(p^2) up to DENSE_MAX_PAIRS candidate node pairs p, above it O(p + n^2 + w),
+    n is the number of nodes and w the number of non-zero relation weights.
+
+    """
+
+    def __init__(self, candidate_mappings, weight_dict, instance_len):
+        """
+        candidate_mappings: candidate node match list (see SmatchScript.compute_pool)
+        weight_dict: weight dictionary (see SmatchScript.compute_pool)
+        instance_len: the number of the nodes in AMR 2
+
+        """
+        self.node_num = len(candidate_mappings)
+        self.instance_len = instance_len
+
+        # candidate node pairs sorted by (node in AMR 1, node in AMR 2), this is the order moves are tried in
+        pairs = sorted(weight_dict)
+        pair_num = len(pairs)
+        # index pair_num stands for "no candidate pair" (unmapped node or pair outside of the pool)
+        self.null = pair_num
+
+        # pair_index[i, j] is the index of candidate pair (i, j), the last column is used for unmapped nodes (-1)
+        self.pair_index = np.full((self.node_num, instance_len + 1), self.null, dtype=np.int64)
+        self.pair_node1 = np.zeros(pair_num, dtype=np.int64)
+        self.pair_node2 = np.zeros(pair_num, dtype=np.int64)
+        for q, (node1, node2) in enumerate(pairs):
+            self.pair_index[node1, node2] = q
+            self.pair_node1[q] = node1
+            self.pair_node2[q] = node2
+
+        self.weights = np.zeros(pair_num + 1, dtype=np.int64)
+        rows, columns, values = [], [], []
+        for q, pair in enumerate(pairs):
+            for key, weight in weight_dict[pair].items():
+                if key == -1:
+                    self.weights[q] = weight
+                else:
+                    rows.append(q)
+                    columns.append(self.pair_index[key])
+                    values.append(weight)
+        rows = np.array(rows, dtype=np.int64)
+        columns = np.array(columns, dtype=np.int64)
+        values = np.array(values, dtype=np.int64)
+        self.size = pair_num + 1
+        if pair_num <= DENSE_MAX_PAIRS:
+            self.relation_matrix = np.zeros((self.size, self.size), dtype=np.int32)
+            self.relation_matrix[rows, columns] = values
+        else:
+            self.relation_matrix = None
+            # relation weights by flat key, ending with a key larger than any other,
+            # so a lookup never runs past the end
+            keys = rows * self.size + columns
+            order = np.argsort(keys, kind='stable')
+            self.relation_keys = np.append(keys[order], self.size * self.size)
+            self.relation_values = np.append(values[order], 0)
+            # column r: rows column_rows[column_start[r]:column_start[r + 1]] with weights column_values[...]
+            order = np.argsort(columns, kind='stable')
+            self.column_rows = rows[order]
+            self.column_values = values[order]
+            self.column_start = np.zeros(self.size + 1, dtype=np.int64)
+            np.cumsum(np.bincount(columns, minlength=self.size), out=self.column_start[1:])
+
+        # all swaps (i, j), i < j, in the order of get_best_gain
+        self.swap_node1, self.swap_node2 = np.triu_indices(self.node_num, 1)
+
+    def relation_weight(self, rows, columns):
+        """
+        Relation weights of node pairs rows[k] and columns[k] (arrays of candidate pair indices).
+
+        """
+        if self.relation_matrix is not None:
+            return self.relation_matrix[rows, columns]
+        keys = rows * self.size + columns
+        positions = np.searchsorted(self.relation_keys, keys)
+        return np.where(self.relation_keys[positions] == keys, self.relation_values[positions], 0)
+
+    def add_column(self, contribution, column, sign):
+        """
+        Add (sign 1) or subtract (sign -1) relation weights of node pair column to the contribution vector.
+
+        """
+        if self.relation_matrix is not None:
+            if sign > 0:
+                contribution += self.relation_matrix[:, column]
+            else:
+                contribution -= self.relation_matrix[:, column]
+            return
+        start, end = self.column_start[column], self.column_start[column + 1]
+        # rows of a column are unique, so fancy indexing adds every weight
+        contribution[self.column_rows[start:end]] += sign * self.column_values[start:end]
+
+    def hill_climb(self, mapping, max_steps=None, budget=None, upper_bound=None):
+        """
+        Hill-climbing from the given mapping until there is no gain from any move or swap.
+        Arguments:
+            mapping: initial node mapping, the ith entry is the node index in AMR 2 which maps to the ith node in AMR 1
+            max_steps: maximal number of hill-climbing steps (no limit by default)
+            budget: SearchBudget shared by all restarts of the AMR pair (optional)
+            upper_bound: stop when this triple match number is reached (optional)
+        Returns:
+            the node mapping and its triple match number
+
+        """
+        node_map = np.array(mapping, dtype=np.int64)
+        # active candidate pair of every node in AMR 1
+        current = self.pair_index[np.arange(self.node_num), node_map]
+        # which nodes of AMR 2 are already matched, the last entry corresponds to -1
+        matched = np.zeros(self.instance_len + 1, dtype=bool)
+        matched[node_map] = True
+
+        contribution = np.zeros(self.size, dtype=np.int64)
+        for q in current:
+            self.add_column(contribution, q, 1)
+        match_num = int(self.weights[current].sum() + contribution[current].sum() // 2)
+
+        weights = self.weights
+        relation_weight = self.relation_weight
+        move_num = len(self.pair_node1)
+        move_range = np.arange(move_num)
+        step = 0
+        while max_steps is None or step < max_steps:
+            if upper_bound is not None and match_num >= upper_bound:
+                break
+            if budget is not None and not budget.step():
+                break
+            step += 1
+            # gain of moving node i from its current pair a to the candidate pair q = (i, j), j is unmatched
+            old = current[self.pair_node1]
+            move_gains = (weights[:-1] + contribution[:-1] - relation_weight(move_range, old)
+                          - weights[old] - contribution[old])
+            move_gains[matched[self.pair_node2]] = 0
+
+            # gain of swapping AMR 2 nodes of nodes i < j
+            old1 = current[self.swap_node1]
+            old2 = current[self.swap_node2]
+            new1 = self.pair_index[self.swap_node1, node_map[self.swap_node2]]
+            new2 = self.pair_index[self.swap_node2, node_map[self.swap_node1]]
+            swap_gains = (weights[new1] + contribution[new1]
+                          - relation_weight(new1, old1) - relation_weight(new1, old2) + relation_weight(new1, new2)
+                          + weights[new2] + contribution[new2]
+                          - relation_weight(new2, old1) - relation_weight(new2, old2)
+                          - weights[old1] - contribution[old1] - weights[old2] - contribution[old2]
+                          + relation_weight(old1, old2))
+
+            # the first largest gain wins, moves are tried before swaps
+            best_move = int(move_gains.argmax()) if move_num else 0
+            best_move_gain = int(move_gains[best_move]) if move_num else 0
+            best_swap = int(swap_gains.argmax()) if len(swap_gains) else 0
+            best_swap_gain = int(swap_gains[best_swap]) if len(swap_gains) else 0
+            if max(best_move_gain, best_swap_gain) <= 0:
+                break
+
+            if best_swap_gain > best_move_gain:
+                node1 = self.swap_node1[best_swap]
+                node2 = self.swap_node2[best_swap]
+                removed = (old1[best_swap], old2[best_swap])
+                added = (new1[best_swap], new2[best_swap])
+                node_map[node1], node_map[node2] = node_map[node2], node_map[node1]
+                current[node1], current[node2] = added
+                match_num += best_swap_gain
+            else:
+                node1 = self.pair_node1[best_move]
+                removed = (current[node1],)
+                added = (best_move,)
+                matched[node_map[node1]] = False
+                node_map[node1] = self.pair_node2[best_move]
+                matched[node_map[node1]] = True
+                current[node1] = best_move
+                match_num += best_move_gain
+            for q in removed:
+                self.add_column(contribution, q, -1)
+            for q in added:
+                self.add_column(contribution, q, 1)
+
+        return node_map.tolist(), match_num
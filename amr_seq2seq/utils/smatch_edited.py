@@ -13,18 +13,38 @@ from __future__ import division
 
 try:
     from . import amr
+    from .lru_cache import LRUCache
+    from .smatch_cache import PairScoreCache
 except:
     import amr
+    from lru_cache import LRUCache
+    from smatch_cache import PairScoreCache
 
 import os
+import json
+import multiprocessing
+import time
+import hashlib
 import logging
 import random
+import re
 import sys
 import argparse
+from array import array
+from collections import Counter, OrderedDict
+from itertools import islice, zip_longest
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.CRITICAL)
 
+# fine-grained sub-scores computed from the best node mapping (see SmatchScript.fine_grained_counts)
+FINE_GRAINED_NAMES = ('Unlabeled', 'No WSD', 'Concepts', 'NER', 'Negations', 'Wikification', 'Reentrancies', 'SRL')
+
+# buffer size of the command line output (bytes)
+OUTPUT_BUFFER_SIZE = 1 << 16
+# number of AMR pairs read at once per worker process of the command line tool (--jobs)
+PARALLEL_BLOCK_SIZE = 256
+
 
 def build_arg_parser():
     """
@@ -32,8 +52,11 @@ def build_arg_parser():
 
     """
     parser = argparse.ArgumentParser(description="Smatch calculator -- arguments")
-    parser.add_argument('-f', nargs=2, required=True, type=str,
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-f', nargs=2, type=str,
                         help='Two files containing AMR pairs. AMRs in each file are separated by a single blank line')
+    inputs.add_argument('--merge', nargs='+', type=str,
+                        help='Instead of scoring, merge count files saved with --counts_out and report the score')
     parser.add_argument('-r', type=int, default=4, help='Restart number (Default:4)')
     parser.add_argument('--significant', type=int, default=4, help='significant digits to output (default: 2)')
     parser.add_argument('-v', action='store_true', help='Verbose output (Default:false)')
@@ -51,12 +74,314 @@ def build_arg_parser():
                         help="just pay attention to matching attributes")
     parser.add_argument('--justrelation', action='store_true', default=False,
                         help="just pay attention to matching relations")
+    parser.add_argument('--engine', default='dict', choices=['dict', 'dense'], type=str,
+                        help="Hill-climbing engine: nested dictionaries or dense NumPy arrays (default dict)")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="Random seed for restarts, makes scores reproducible (Default: random)")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="SQLite file caching scores of AMR pairs between runs (Default: no cache)")
+    parser.add_argument('--counts_out', type=str, default=None,
+                        help="Save accumulated counts to this file (json), e.g. for merging scores of file shards")
+    parser.add_argument('--max_time', type=float, default=None,
+                        help="Time budget of one AMR pair in seconds, the best mapping found so far is used "
+                             "when it runs out (Default: no limit)")
+    parser.add_argument('--max_steps', type=int, default=None,
+                        help="Budget of search steps of one AMR pair over all restarts (Default: no limit)")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of worker processes scoring AMR pairs, the score is the same as with one "
+                             "process if --seed is given (Default: 1)")
+    parser.add_argument('--pair_counts_out', type=str, default=None,
+                        help="Save (match, test, gold) triple numbers of every AMR pair to this file (tsv), "
+                             "e.g. for significance tests with smatch_significance.py")
+    parser.add_argument('--fine_grained', action='store_true', default=False,
+                        help="Also report fine-grained scores (unlabeled, no WSD, concepts, NER, negations, "
+                             "wikification, reentrancies, SRL) computed from the best mapping")
+    parser.add_argument('--quiet', action='store_true', default=False,
+                        help="Do not show the progress bar")
+    parser.add_argument('--exact_threshold', type=int, default=0,
+                        help="Find the best mapping exactly (branch-and-bound) when both AMRs have at most "
+                             "this number of nodes, instead of hill-climbing (Default: 0, never)")
 
     return parser
 
 
+class TripleIndex(object):
+    """
+    Triples of a single AMR prepared for candidate pool computation.
+    Labels are normalized and interned in the global symbol table (amr.SYMBOLS, so the index is only valid
+    in its process and until amr.trim_symbols resets the table), and node names are converted
+    to node indices only once, so labels are compared as integers. Triples are grouped by their label,
+    so triples of two AMRs are compared only when they share the same label (hash join instead of nested loops).
+
+    instances: list of (label, node index), label is the normalized id of the concept
+    attributes: list of (label, node index), label is (normalized id of attribute name, normalized id of value)
+    relations: list of (label, node 1 index, node 2 index), label is the normalized id of the relation name
+    instance_groups, attribute_groups, relation_groups: the same items grouped by label (order is preserved)
+
+    """
+
+    def __init__(self, instance, attribute, relation, prefix):
+        """
+        instance: instance triples ("instance", node name, node value)
+        attribute: attribute triples (attribute name, node name, attribute value)
+        relation: relation triples (relation name, node 1 name, node 2 name)
+        prefix: prefix of node names, node index is obtained by stripping it
+
+        """
+        label = amr.SYMBOLS.normalized_id
+        prefix_len = len(prefix)
+        self.node_num = len(instance)
+
+        self.instances = [(label(t[2]), int(t[1][prefix_len:])) for t in instance]
+        self.attributes = [((label(t[0]), label(t[2])), int(t[1][prefix_len:])) for t in attribute]
+        self.relations = [(label(t[0]), int(t[1][prefix_len:]), int(t[2][prefix_len:])) for t in relation]
+        self._group()
+
+    @classmethod
+    def from_graph(cls, graph):
+        """
+        Index of a CompactAMR, the same as of its triples, but built from the symbol ids without string operations.
+
+        """
+        labels = amr.SYMBOLS.normalized
+        index = cls.__new__(cls)
+        index.node_num = len(graph.concepts)
+        index.instances = [(labels[concept], i) for i, concept in enumerate(graph.concepts)]
+        index.attributes = [((labels[name], labels[value]), i) for i, name, value in
+                            zip(graph.attribute_node, graph.attribute_label, graph.attribute_value)]
+        index.relations = [(labels[name], source, target) for source, target, name in
+                           zip(graph.edge_source, graph.edge_target, graph.edge_label)]
+        index._group()
+        return index
+
+    def estimated_size(self):
+        """
+        Approximate memory of the index in bytes: lists, tuples and dictionaries
+        (labels are ids of the symbol table and small node indices are shared, so they are not counted).
+
+        """
+        size = sys.getsizeof(self)
+        for items in (self.instances, self.attributes, self.relations):
+            size += sys.getsizeof(items) + sum(sys.getsizeof(item) for item in items)
+        size += sum(sys.getsizeof(item[0]) for item in self.attributes)
+        for groups in (self.instance_groups, self.attribute_groups, self.relation_groups):
+            size += sys.getsizeof(groups) + sum(sys.getsizeof(group) for group in groups.values())
+        size += sum(sys.getsizeof(pair) for group in self.relation_groups.values() for pair in group)
+        return size
+
+    def _group(self):
+        self.instance_groups = {}
+        for label, node_index in self.instances:
+            self.instance_groups.setdefault(label, []).append(node_index)
+        self.attribute_groups = {}
+        for label, node_index in self.attributes:
+            self.attribute_groups.setdefault(label, []).append(node_index)
+        self.relation_groups = {}
+        for label, node1_index, node2_index in self.relations:
+            self.relation_groups.setdefault(label, []).append((node1_index, node2_index))
+
+
+class SearchBudget(object):
+    """
+    Anytime budget of the node mapping search of one AMR pair.
+    The search calls step() before every step and stops as soon as it returns False,
+    the best mapping found so far is used then.
+
+    """
+
+    def __init__(self, max_time=None, max_steps=None):
+        """
+        max_time: wall-clock limit in seconds (None for no limit)
+        max_steps: limit of search steps (hill-climbing steps, branch-and-bound nodes) over all restarts
+                   (None for no limit)
+
+        """
+        self.deadline = None if max_time is None else time.perf_counter() + max_time
+        self.steps_left = max_steps
+        # "time" or "step" when the budget has run out
+        self.exhausted = None
+
+    def step(self):
+        """
+        Spend one hill-climbing step. Returns False if the budget has run out.
+
+        """
+        if self.exhausted is not None:
+            return False
+        if self.steps_left is not None:
+            if self.steps_left <= 0:
+                self.exhausted = "step"
+                return False
+            self.steps_left -= 1
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            self.exhausted = "time"
+            return False
+        return True
+
+
+class MappingHashTable(object):
+    """
+    Bounded memo of triple match numbers of node mappings, keyed by 64-bit Zobrist hashes of the mappings
+    (see SmatchScript.mapping_hash).
+    The table is direct-mapped: a hash has a single slot and a new entry overwrites the old one,
+    so the memory is fixed however many mappings are visited. Entries are tagged with a generation,
+    so clear() is O(1). Two mappings with the same 64-bit hash are practically impossible.
+
+    """
+
+    def __init__(self, size=65536):
+        """
+        size: number of slots, rounded up to a power of two
+
+        """
+        if size < 1:
+            raise ValueError("MappingHashTable size should be positive, got {0}".format(size))
+        size = 1 << (size - 1).bit_length()
+        self.mask = size - 1
+        self.generation = 1
+        self._keys = [0] * size
+        self._values = [0] * size
+        self._generations = [0] * size
+
+    def get(self, key):
+        """
+        Return the saved match number of the mapping with the given hash or None.
+
+        """
+        slot = key & self.mask
+        if self._generations[slot] == self.generation and self._keys[slot] == key:
+            return self._values[slot]
+        return None
+
+    def put(self, key, value):
+        slot = key & self.mask
+        self._keys[slot] = key
+        self._values[slot] = value
+        self._generations[slot] = self.generation
+
+    def clear(self):
+        self.generation += 1
+
+
+class PreparedAMR(object):
+    """
+    AMR parsed once for scoring: the parsed graph and its TripleIndex. Matching only uses the index
+    (integer labels), string triples with nodes renamed to prefix + node index are built on demand (see triples).
+    Scoring does not modify it, so it can be reused for several AMR pairs (e.g. cached gold AMRs).
+
+    """
+
+    def __init__(self, cur_amr, prefix):
+        """
+        cur_amr: AMR in one-line format
+        prefix: prefix of node names, e.g. "a" renames nodes to "a0", "a1", .etc
+
+        """
+        # the parsed graph is shared with other users of the parse cache
+        self.graph = amr.parse_AMR_line_cached(cur_amr)
+        self.prefix = prefix
+        # generation of the symbol table the index labels belong to
+        self.generation = amr.SYMBOLS.generation
+        self.index = TripleIndex.from_graph(self.graph)
+
+    def triples(self):
+        """
+        Instance, attribute and relation triples with nodes renamed to prefix + node index
+        (only for printing, matching uses the index).
+
+        """
+        return self.graph.get_triples(self.prefix)
+
+    def estimated_size(self):
+        """
+        Approximate memory of the prepared AMR in bytes: arrays of the parsed graph and the index
+        (labels are ids of the symbol table, so they are not counted). Used to limit the gold AMR cache.
+
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.graph)
+        for slot in self.graph.__slots__:
+            size += sys.getsizeof(getattr(self.graph, slot))
+        return size + self.index.estimated_size()
+
+
+class SmatchCounts(object):
+    """
+    Accumulated smatch statistics: matching triple number, triple numbers of test and gold AMRs
+    and the number of scored AMR pairs.
+    All the statistics are integers, so counts computed by several processes, machines or on shards
+    of a file can be merged without loss of precision and give the same corpus-level score.
+
+    """
+
+    FIELDS = ('match_num', 'test_num', 'gold_num', 'pair_num')
+
+    def __init__(self, match_num=0, test_num=0, gold_num=0, pair_num=0):
+        self.match_num = match_num
+        self.test_num = test_num
+        self.gold_num = gold_num
+        self.pair_num = pair_num
+
+    def add(self, match_num, test_num, gold_num):
+        """
+        Add the scores of a single AMR pair.
+
+        """
+        self.match_num += match_num
+        self.test_num += test_num
+        self.gold_num += gold_num
+        self.pair_num += 1
+
+    def merge(self, other):
+        """
+        Add counts of other SmatchCounts in place. Returns self.
+
+        """
+        self.match_num += other.match_num
+        self.test_num += other.test_num
+        self.gold_num += other.gold_num
+        self.pair_num += other.pair_num
+        return self
+
+    def __add__(self, other):
+        return SmatchCounts(*self.to_list()).merge(other)
+
+    def __radd__(self, other):
+        # allows sum() over a list of counts
+        if other == 0:
+            return SmatchCounts(*self.to_list())
+        return self.__add__(other)
+
+    def __eq__(self, other):
+        return isinstance(other, SmatchCounts) and self.to_list() == other.to_list()
+
+    def __repr__(self):
+        return "SmatchCounts({0})".format(", ".join("{0}={1}".format(k, v) for k, v in self.to_dict().items()))
+
+    def to_list(self):
+        return [getattr(self, field) for field in self.FIELDS]
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, counts_dict):
+        return cls(**{field: int(counts_dict.get(field, 0)) for field in cls.FIELDS})
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+
 class SmatchScript:
 
+    # search nodes the exact search may expand before it gives up and hill-climbing restarts continue
+    EXACT_MAX_NODES = 20000
+
     def __init__(self,
                  r=4,
                  significant=4,
@@ -67,6 +392,17 @@ class SmatchScript:
                  justinstance=False,
                  justattribute=False,
                  justrelation=False,
+                 engine='dict',
+                 seed=None,
+                 gold_cache=None,
+                 score_cache=None,
+                 max_time=None,
+                 max_steps=None,
+                 exact_threshold=0,
+                 match_cache_size=65536,
+                 out=None,
+                 fine_grained=False,
+                 keep_pair_counts=False,
                  **kwargs):
         # logging.critical(r,significant,v,vv,ms,pr,justinstance,justattribute,justrelation,kwargs)
         # total number of iteration in smatch computation
@@ -85,10 +421,15 @@ class SmatchScript:
         # Default false (do not output precision and recall, just output F score)
         self.pr_flag = False
 
-        # dictionary to save pre-computed node mapping and its resulting triple match count
-        # key: tuples of node mapping
+        # table to save pre-computed node mapping and its resulting triple match count
+        # key: Zobrist hash of node mapping (see mapping_hash)
         # value: the matching triple count
-        self.match_triple_dict = {}
+        self.match_triple_dict = MappingHashTable(match_cache_size)
+        # random 64-bit keys of node pairs: zobrist_keys[i][j + 1] for node i in AMR 1 mapped to node j in AMR 2
+        # (j = -1 for unmapped nodes), the hash of a mapping is the xor of keys of all its node pairs.
+        # Keys are grown on demand and shared by all AMR pairs.
+        self.zobrist_keys = []
+        self._zobrist_random = random.Random(0)
 
         self.verbose = v
         self.veryVerbose = vv
@@ -105,16 +446,50 @@ class SmatchScript:
 
         self.significant = significant
 
-        # matching triple number
-        self.total_match_num = 0
-        # triple number in test file
-        self.total_test_num = 0
-        # triple number in gold file
-        self.total_gold_num = 0
-        # sentence number
-        self.sent_num = 1
+        # hill-climbing engine, "dict" walks weight_dict, "dense" uses NumPy arrays (see smatch_dense)
+        if engine not in ('dict', 'dense'):
+            raise ValueError("Unknown smatch engine: {0}".format(engine))
+        self.engine = engine
+        # random seed for initial mappings, None means a new random state for every AMR pair
+        self.seed = seed
+        # LRUCache of PreparedAMR objects of gold AMRs (keyed by hash of the gold AMR string), None to disable.
+        # The cache can be shared between SmatchScript objects, e.g. between validation epochs.
+        self.gold_cache = gold_cache
+        # PairScoreCache of scores of AMR pairs, None to disable
+        self.score_cache = score_cache
+        # per-pair budget of the mapping search (seconds and hill-climbing steps), None means no limit.
+        # A time budget makes scores depend on the machine speed.
+        self.max_time = max_time
+        self.max_steps = max_steps
+        # AMR pairs with at most this number of nodes in both AMRs are scored exactly by branch-and-bound
+        # instead of hill-climbing with restarts, 0 disables the exact search
+        self.exact_threshold = exact_threshold
+        # how the mapping search of scored AMR pairs ended:
+        # upper_bound - the best possible match number was reached, the remaining restarts were skipped
+        # exact - the best mapping was found by the exact search
+        # time_budget, step_budget - the budget ran out
+        # all_restarts - all restarts were run
+        # restarts counts the restarts which were actually run, exact_gave_up the exact searches which hit
+        # EXACT_MAX_NODES (the pair is then scored by hill-climbing)
+        # pairs scored in worker processes are counted there and added with add_search_stats
+        self.search_stats = {'upper_bound': 0, 'exact': 0, 'time_budget': 0, 'step_budget': 0,
+                             'all_restarts': 0, 'restarts': 0, 'exact_gave_up': 0}
+
+        # matching triple number, triple number in test file, triple number in gold file and sentence number
+        self.counts = SmatchCounts()
+        # (match_num, test_num, gold_num) of every scored AMR pair in order, flat (see pair_counts),
+        # only recorded if keep_pair_counts is set, as it grows with the number of scored pairs
+        self.keep_pair_counts = keep_pair_counts
+        self._pair_counts = array('q')
+        # fine-grained sub-scores (FINE_GRAINED_NAMES) computed from the same best mapping, None to disable
+        self.fine_grained = fine_grained
+        self.fine_counts = None
+        if fine_grained:
+            self.fine_counts = OrderedDict((name, SmatchCounts()) for name in FINE_GRAINED_NAMES)
         # significant digits to print out
         self.floatdisplay = "%%.%df" % self.significant
+        # stream scores are printed to, None for sys.stdout
+        self.out = out
         # Read amr pairs from two files
 
         self.iteration_num = r + 1
@@ -133,44 +508,114 @@ class SmatchScript:
             self.doinstance = False
             self.doattribute = False
 
+    @property
+    def total_match_num(self):
+        return self.counts.match_num
+
+    @property
+    def total_test_num(self):
+        return self.counts.test_num
+
+    @property
+    def total_gold_num(self):
+        return self.counts.gold_num
+
+    @property
+    def sent_num(self):
+        # sentence number (1-based index of the next AMR pair)
+        return self.counts.pair_num + 1
+
+    def merge(self, other):
+        """
+        Merge counts of another SmatchScript or SmatchCounts into this one.
+
+        """
+        if isinstance(other, SmatchScript):
+            if self.keep_pair_counts:
+                self._pair_counts.extend(other._pair_counts)
+            if self.fine_counts is not None and other.fine_counts is not None:
+                for name, counts in self.fine_counts.items():
+                    counts.merge(other.fine_counts[name])
+            other = other.counts
+        self.counts.merge(other)
+        return self
+
+    @property
+    def pair_counts(self):
+        """
+        NumPy int64 array of shape (number of AMR pairs, 3): (match_num, test_num, gold_num) of every scored AMR pair
+        in the order they were accumulated, e.g. for significance tests (see smatch_significance).
+        Only pairs accumulated while keep_pair_counts was set are included.
+
+        """
+        import numpy as np
+        return np.frombuffer(self._pair_counts, dtype=np.int64).reshape(-1, 3).copy()
+
+    def save_pair_counts(self, path):
+        """
+        Save per-pair counts to a tab separated file, one AMR pair per line.
+
+        """
+        with open(path, 'w') as f:
+            for k in range(0, len(self._pair_counts), 3):
+                f.write("{0}\t{1}\t{2}\n".format(*self._pair_counts[k:k + 3]))
+
     @staticmethod
     def get_amr_line(input_f):
         """
         Read the file containing AMRs. AMRs are separated by a blank line.
-        Each call of get_amr_line() returns the next available AMR (in one-line form).
+        Returns the list of all AMRs (in one-line form), see iter_amr_lines.
+        Note: this function does not verify if the AMR is valid"""
+
+        return list(SmatchScript.iter_amr_lines(input_f))
+
+    @staticmethod
+    def iter_amr_lines(input_f):
+        """
+        Read the file containing AMRs lazily. AMRs are separated by a blank line.
+        Yields the AMRs one by one (in one-line form), so only one AMR is kept in memory.
         Note: this function does not verify if the AMR is valid"""
 
-        all_amrs = []
         cur_amr = []
         has_content = False
 
-        for line in open(input_f, 'r'):
-            line = line.strip()
-            if line == "":
-                if not has_content:
-                    # empty lines before current AMR
+        with open(input_f, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line == "":
+                    if not has_content:
+                        # empty lines before current AMR
+                        continue
+                    else:
+                        # end of current AMR
+                        yield "".join(cur_amr)
+                        cur_amr = []
+                        has_content = False
+                        continue
+                if line.startswith("#"):
+                    # ignore the comment line (starting with "#") in the AMR file
                     continue
                 else:
-                    # end of current AMR
-                    all_amrs.append("".join(cur_amr))
-                    cur_amr = []
-                    has_content = False
-                    continue
-            if line.strip().startswith("#"):
-                # ignore the comment line (starting with "#") in the AMR file
-                continue
-            else:
-                has_content = True
-                cur_amr.append(line.strip())
+                    has_content = True
+                    cur_amr.append(line)
 
         if cur_amr != []:
-            all_amrs.append("".join(cur_amr))
+            yield "".join(cur_amr)
 
-        return all_amrs
+    @staticmethod
+    def iter_one_line_amrs(input_f):
+        """
+        Read the file containing one AMR per line lazily.
+
+        """
+        with open(input_f, 'r') as f:
+            for line in f:
+                yield line.strip()
 
     def get_best_match(self, instance1, attribute1, relation1,
                        instance2, attribute2, relation2,
-                       prefix1, prefix2, doinstance=True, doattribute=True, dorelation=True):
+                       prefix1, prefix2, doinstance=True, doattribute=True, dorelation=True, rng=None,
+                       index1=None, index2=None):
         """
         Get the highest triple match number between two sets of triples via hill-climbing.
         Arguments:
@@ -182,6 +627,29 @@ class SmatchScript:
             relation2: relation triples of AMR 2 (relation name, node 1 name, node 2 name)
             prefix1: prefix label for AMR 1
             prefix2: prefix label for AMR 2
+            rng: random.Random used for initial mappings (module random with a fresh seed by default)
+            index1, index2: precomputed TripleIndex of AMR 1 and AMR 2 (optional)
+        Returns:
+            best_match: the node mapping that results in the highest triple matching number
+            best_match_num: the highest triple matching number
+
+        """
+        if index1 is None or index2 is None:
+            index1 = TripleIndex(instance1, attribute1, relation1, prefix1)
+            index2 = TripleIndex(instance2, attribute2, relation2, prefix2)
+        return self.get_best_match_from_index(index1, index2, [t[2] for t in instance1], [t[2] for t in instance2],
+                                              doinstance=doinstance, doattribute=doattribute, dorelation=dorelation,
+                                              rng=rng)
+
+    def get_best_match_from_index(self, index1, index2, values1, values2, doinstance=True, doattribute=True,
+                                  dorelation=True, rng=None):
+        """
+        Get the highest triple match number between two AMRs via hill-climbing (see get_best_match).
+        Arguments:
+            index1, index2: TripleIndex of AMR 1 and AMR 2
+            values1, values2: node values (concepts) of AMR 1 and AMR 2 for the smart initialization,
+                              strings or any other values equal exactly when the concepts are (e.g. symbol ids)
+            rng: random.Random used for initial mappings (module random with a fresh seed by default)
         Returns:
             best_match: the node mapping that results in the highest triple matching number
             best_match_num: the highest triple matching number
@@ -190,61 +658,162 @@ class SmatchScript:
         # Compute candidate pool - all possible node match candidates.
         # In the hill-climbing, we only consider candidate in this pool to save computing time.
         # weight_dict is a dictionary that maps a pair of node
-        (candidate_mappings, weight_dict) = self.compute_pool(instance1, attribute1, relation1,
-                                                              instance2, attribute2, relation2,
-                                                              prefix1, prefix2, doinstance=doinstance,
-                                                              doattribute=doattribute,
-                                                              dorelation=dorelation)
+        (candidate_mappings, weight_dict) = self.compute_pool_from_index(index1, index2, doinstance=doinstance,
+                                                                         doattribute=doattribute,
+                                                                         dorelation=dorelation)
         if self.veryVerbose:
             logger.info("Candidate mappings:")
             logger.info(candidate_mappings)
             logger.info("Weight dictionary")
             logger.info(weight_dict)
 
+        # no mapping can match more triples, so the search stops as soon as it is reached
+        upper_bound = self.match_upper_bound(index1, index2, doinstance=doinstance, doattribute=doattribute,
+                                             dorelation=dorelation)
+        budget = None
+        if self.max_time is not None or self.max_steps is not None:
+            budget = SearchBudget(self.max_time, self.max_steps)
+
+        dense_engine = None
+        if self.engine == 'dense' and upper_bound > 0:
+            try:
+                from .smatch_dense import DenseMatchEngine
+            except ImportError:
+                from smatch_dense import DenseMatchEngine
+            dense_engine = DenseMatchEngine(candidate_mappings, weight_dict, index2.node_num)
+
+        # small graphs are solved exactly by branch-and-bound (see smatch_exact)
+        exact = 0 < max(index1.node_num, index2.node_num) <= self.exact_threshold
+
         best_match_num = 0
         # initialize best match mapping
         # the ith entry is the node index in AMR 2 which maps to the ith node in AMR 1
-        best_mapping = [-1] * len(instance1)
+        best_mapping = [-1] * index1.node_num
+        stop_reason = 'all_restarts'
         for i in range(self.iteration_num):
+            if best_match_num >= upper_bound:
+                stop_reason = 'upper_bound'
+                break
+            if budget is not None and budget.exhausted is not None:
+                break
             if self.veryVerbose:
                 logger.info("Iteration", i)
             if i == 0:
                 # smart initialization used for the first round
-                cur_mapping = self.smart_init_mapping(candidate_mappings, instance1, instance2)
+                cur_mapping = self.smart_init_mapping_from_values(candidate_mappings, values1, values2, rng=rng)
             else:
                 # random initialization for the other round
-                cur_mapping = self.random_init_mapping(candidate_mappings)
-            # compute current triple match number
-            match_num = self.compute_match(cur_mapping, weight_dict)
-            if self.veryVerbose:
-                logger.info("Node mapping at start", cur_mapping)
-                logger.info("Triple match number at start:", match_num)
-            while True:
-                # get best gain
-                (gain, new_mapping) = self.get_best_gain(cur_mapping, candidate_mappings, weight_dict,
-                                                         len(instance2), match_num)
-                if self.veryVerbose:
-                    logger.info("Gain after the hill-climbing", gain)
-                # hill-climbing until there will be no gain for new node mapping
-                if gain <= 0:
-                    break
-                # otherwise update match_num and mapping
-                match_num += gain
-                cur_mapping = new_mapping[:]
-                if self.veryVerbose:
-                    logger.info("Update triple match number to:", match_num)
-                    logger.info("Current mapping:", cur_mapping)
+                cur_mapping = self.random_init_mapping(candidate_mappings, rng=rng)
+            self.search_stats['restarts'] += 1
+            if dense_engine is not None:
+                cur_mapping, match_num = dense_engine.hill_climb(cur_mapping, budget=budget,
+                                                                 upper_bound=upper_bound)
+            else:
+                cur_mapping, match_num = self.hill_climb(cur_mapping, candidate_mappings, weight_dict,
+                                                         index2.node_num, budget=budget, upper_bound=upper_bound)
             if match_num > best_match_num:
                 best_mapping = cur_mapping[:]
                 best_match_num = match_num
+            if exact and best_match_num < upper_bound:
+                # the first hill-climbing result prunes the exact search, no other restarts are needed
+                try:
+                    from .smatch_exact import ExactMatchSolver
+                except ImportError:
+                    from smatch_exact import ExactMatchSolver
+                solver = ExactMatchSolver(candidate_mappings, weight_dict)
+                best_mapping, best_match_num = solver.solve(best_mapping, best_match_num, budget=budget,
+                                                            upper_bound=upper_bound, max_nodes=self.EXACT_MAX_NODES)
+                if solver.complete:
+                    stop_reason = 'exact'
+                    break
+                # the exact search gave up, the remaining restarts are run as usual
+                self.search_stats['exact_gave_up'] += 1
+                exact = False
+        if budget is not None and budget.exhausted is not None and stop_reason != 'upper_bound':
+            stop_reason = budget.exhausted + '_budget'
+        self.search_stats[stop_reason] += 1
         return best_mapping, best_match_num
 
+    @staticmethod
+    def match_upper_bound(index1, index2, doinstance=True, doattribute=True, dorelation=True):
+        """
+        Upper bound of the triple match number of two AMRs over all node mappings.
+        Triples match only when their labels are the same, and under a one-to-one node mapping a triple of one AMR
+        matches only copies of a single triple of the other one, so a label group of c1 and c2 triples
+        (with at most m1 and m2 copies of the same triple) gives at most min(c1 * m2, c2 * m1) matches.
+        Without duplicate triples the bound is min(c1, c2) per label, never more than min(test, gold triple number).
+
+        Arguments:
+            index1: TripleIndex of AMR 1
+            index2: TripleIndex of AMR 2
+        Returns:
+            the upper bound of the triple match number
+
+        """
+        groups = []
+        if doinstance:
+            groups.append((index1.instance_groups, index2.instance_groups))
+        if doattribute:
+            groups.append((index1.attribute_groups, index2.attribute_groups))
+        if dorelation:
+            groups.append((index1.relation_groups, index2.relation_groups))
+        upper_bound = 0
+        for groups1, groups2 in groups:
+            for label, items1 in groups1.items():
+                items2 = groups2.get(label)
+                if not items2:
+                    continue
+                copies1 = 1 if len(set(items1)) == len(items1) else max(Counter(items1).values())
+                copies2 = 1 if len(set(items2)) == len(items2) else max(Counter(items2).values())
+                upper_bound += min(len(items1) * copies2, len(items2) * copies1)
+        return upper_bound
+
+    def hill_climb(self, cur_mapping, candidate_mappings, weight_dict, instance_len, budget=None,
+                   upper_bound=None):
+        """
+        Hill-climbing from the given node mapping until there is no gain from any move or swap.
+        Arguments:
+            cur_mapping: initial node mapping
+            candidate_mappings: the candidates mapping list
+            weight_dict: the weight dictionary
+            instance_len: the number of the nodes in AMR 2
+            budget: SearchBudget limiting the number of steps (optional)
+            upper_bound: stop when this triple match number is reached (optional)
+        Returns:
+            the node mapping and its triple match number
+
+        """
+        self.prepare_mapping_hash(len(cur_mapping), instance_len)
+        # compute current triple match number
+        match_num = self.compute_match(cur_mapping, weight_dict)
+        if self.veryVerbose:
+            logger.info("Node mapping at start", cur_mapping)
+            logger.info("Triple match number at start:", match_num)
+        while upper_bound is None or match_num < upper_bound:
+            if budget is not None and not budget.step():
+                break
+            # get best gain
+            (gain, new_mapping) = self.get_best_gain(cur_mapping, candidate_mappings, weight_dict,
+                                                     instance_len, match_num)
+            if self.veryVerbose:
+                logger.info("Gain after the hill-climbing", gain)
+            # hill-climbing until there will be no gain for new node mapping
+            if gain <= 0:
+                break
+            # otherwise update match_num and mapping
+            match_num += gain
+            cur_mapping = new_mapping[:]
+            if self.veryVerbose:
+                logger.info("Update triple match number to:", match_num)
+                logger.info("Current mapping:", cur_mapping)
+        return cur_mapping, match_num
+
     @staticmethod
     def normalize(item):
         """
         lowercase and remove quote signifiers from items that are about to be compared
         """
-        return item.lower().rstrip('_')
+        return amr.normalize_label(item)
 
     def compute_pool(self, instance1, attribute1, relation1,
                      instance2, attribute2, relation2,
@@ -273,116 +842,108 @@ class SmatchScript:
 
 
         """
-        candidate_mapping = []
+        index1 = TripleIndex(instance1, attribute1, relation1, prefix1)
+        index2 = TripleIndex(instance2, attribute2, relation2, prefix2)
+        return self.compute_pool_from_index(index1, index2, doinstance=doinstance,
+                                            doattribute=doattribute, dorelation=dorelation)
+
+    @staticmethod
+    def compute_pool_from_index(index1, index2, doinstance=True, doattribute=True, dorelation=True):
+        """
+        compute candidate pool (see compute_pool) out of two triple indices.
+        Every triple of AMR 1 is only compared with the triples of AMR 2 having the same normalized label,
+        so the result is exactly the same as comparing all triple pairs.
+
+        Arguments:
+            index1: TripleIndex of AMR 1
+            index2: TripleIndex of AMR 2
+        Returns:
+            candidate_mapping: a list of candidate nodes (see compute_pool)
+            weight_dict: a dictionary which contains the matching triple number for every pair of node mapping
+
+        """
+        candidate_mapping = [set() for _ in range(index1.node_num)]
         weight_dict = {}
-        for i in range(0, len(instance1)):  # TODO
-            # each candidate mapping is a set of node indices
-            candidate_mapping.append(set())
-            if doinstance:
-                for j in range(0, len(instance2)):  # TODO
-                    # if both triples are instance triples and have the same value
-                    # get nodes that can possibly match
-                    if self.normalize(instance1[i][0]) == self.normalize(instance2[j][0]) and \
-                            self.normalize(instance1[i][2]) == self.normalize(instance2[j][2]):
-                        # print 'match:\n'
-                        # print instance1[i][0], instance1[j][0]
-                        # print instance1[i][2], instance1[i][2],'\n'
-                        # get node index by stripping the prefix
-                        node1_index = int(instance1[i][1][len(prefix1):])
-                        node2_index = int(instance2[j][1][len(prefix2):])
-                        candidate_mapping[node1_index].add(node2_index)
-                        node_pair = (node1_index, node2_index)
-                        # use -1 as key in weight_dict for instance triples and attribute triples
-                        if node_pair in weight_dict:
-                            weight_dict[node_pair][-1] += 1
-                        else:
-                            weight_dict[node_pair] = {}
-                            weight_dict[node_pair][-1] = 1
+        if doinstance:
+            for label, node1_index in index1.instances:
+                # nodes of AMR 2 having the same concept
+                for node2_index in index2.instance_groups.get(label, ()):
+                    candidate_mapping[node1_index].add(node2_index)
+                    node_pair = (node1_index, node2_index)
+                    # use -1 as key in weight_dict for instance triples and attribute triples
+                    if node_pair in weight_dict:
+                        weight_dict[node_pair][-1] += 1
+                    else:
+                        weight_dict[node_pair] = {-1: 1}
         if doattribute:
-            for i in range(0, len(attribute1)):
-                for j in range(0, len(attribute2)):
-                    # if both attribute relation triple have the same relation name and value
-                    if self.normalize(attribute1[i][0]) == self.normalize(attribute2[j][0]) \
-                            and self.normalize(attribute1[i][2]) == self.normalize(attribute2[j][2]):
-                        node1_index = int(attribute1[i][1][len(prefix1):])
-                        node2_index = int(attribute2[j][1][len(prefix2):])
-                        candidate_mapping[node1_index].add(node2_index)
-                        node_pair = (node1_index, node2_index)
-                        # use -1 as key in weight_dict for instance triples and attribute triples
-                        if node_pair in weight_dict:
-                            weight_dict[node_pair][-1] += 1
-                        else:
-                            weight_dict[node_pair] = {}
-                            weight_dict[node_pair][-1] = 1
-
+            for label, node1_index in index1.attributes:
+                # nodes of AMR 2 having the same attribute name and value
+                for node2_index in index2.attribute_groups.get(label, ()):
+                    candidate_mapping[node1_index].add(node2_index)
+                    node_pair = (node1_index, node2_index)
+                    if node_pair in weight_dict:
+                        weight_dict[node_pair][-1] += 1
+                    else:
+                        weight_dict[node_pair] = {-1: 1}
         if dorelation:
-            for i in range(0, len(relation1)):
-                for j in range(0, len(relation2)):
-                    # if both relation share the same name
-                    if self.normalize(relation1[i][0]) == self.normalize(relation2[j][0]):
-                        node1_index_amr1 = int(relation1[i][1][len(prefix1):])
-                        node1_index_amr2 = int(relation2[j][1][len(prefix2):])
-                        node2_index_amr1 = int(relation1[i][2][len(prefix1):])
-                        node2_index_amr2 = int(relation2[j][2][len(prefix2):])
-                        # add mapping between two nodes
-                        candidate_mapping[node1_index_amr1].add(node1_index_amr2)
-                        candidate_mapping[node2_index_amr1].add(node2_index_amr2)
-                        node_pair1 = (node1_index_amr1, node1_index_amr2)
-                        node_pair2 = (node2_index_amr1, node2_index_amr2)
-                        if node_pair2 != node_pair1:
-                            # update weight_dict weight. Note that we need to update both entries for future search
-                            # i.e weight_dict[node_pair1][node_pair2]
-                            #     weight_dict[node_pair2][node_pair1]
-                            if node1_index_amr1 > node2_index_amr1:
-                                # swap node_pair1 and node_pair2
-                                node_pair1 = (node2_index_amr1, node2_index_amr2)
-                                node_pair2 = (node1_index_amr1, node1_index_amr2)
-                            if node_pair1 in weight_dict:
-                                if node_pair2 in weight_dict[node_pair1]:
-                                    weight_dict[node_pair1][node_pair2] += 1
-                                else:
-                                    weight_dict[node_pair1][node_pair2] = 1
-                            else:
-                                weight_dict[node_pair1] = {}
-                                weight_dict[node_pair1][-1] = 0
-                                weight_dict[node_pair1][node_pair2] = 1
-                            if node_pair2 in weight_dict:
-                                if node_pair1 in weight_dict[node_pair2]:
-                                    weight_dict[node_pair2][node_pair1] += 1
-                                else:
-                                    weight_dict[node_pair2][node_pair1] = 1
-                            else:
-                                weight_dict[node_pair2] = {}
-                                weight_dict[node_pair2][-1] = 0
-                                weight_dict[node_pair2][node_pair1] = 1
+            for label, node1_index_amr1, node2_index_amr1 in index1.relations:
+                # relations of AMR 2 sharing the same name
+                for node1_index_amr2, node2_index_amr2 in index2.relation_groups.get(label, ()):
+                    # add mapping between two nodes
+                    candidate_mapping[node1_index_amr1].add(node1_index_amr2)
+                    candidate_mapping[node2_index_amr1].add(node2_index_amr2)
+                    node_pair1 = (node1_index_amr1, node1_index_amr2)
+                    node_pair2 = (node2_index_amr1, node2_index_amr2)
+                    if node_pair2 != node_pair1:
+                        # update weight_dict weight. Note that we need to update both entries for future search
+                        # i.e weight_dict[node_pair1][node_pair2]
+                        #     weight_dict[node_pair2][node_pair1]
+                        if node1_index_amr1 > node2_index_amr1:
+                            # swap node_pair1 and node_pair2
+                            node_pair1, node_pair2 = node_pair2, node_pair1
+                        if node_pair1 in weight_dict:
+                            weight_dict[node_pair1][node_pair2] = weight_dict[node_pair1].get(node_pair2, 0) + 1
                         else:
-                            # two node pairs are the same. So we only update weight_dict once.
-                            # this generally should not happen.
-                            if node_pair1 in weight_dict:
-                                weight_dict[node_pair1][-1] += 1
-                            else:
-                                weight_dict[node_pair1] = {}
-                                weight_dict[node_pair1][-1] = 1
-        # print 'len weight dict: {0}'.format(len(weight_dict))
-        # print weight_dict,'\n\n'
-        # print 'len candidate mapping: {0}'.format(len(candidate_mapping))
-        # print candidate_mapping ,'\n'
-
+                            weight_dict[node_pair1] = {-1: 0, node_pair2: 1}
+                        if node_pair2 in weight_dict:
+                            weight_dict[node_pair2][node_pair1] = weight_dict[node_pair2].get(node_pair1, 0) + 1
+                        else:
+                            weight_dict[node_pair2] = {-1: 0, node_pair1: 1}
+                    else:
+                        # two node pairs are the same. So we only update weight_dict once.
+                        # this generally should not happen.
+                        if node_pair1 in weight_dict:
+                            weight_dict[node_pair1][-1] += 1
+                        else:
+                            weight_dict[node_pair1] = {-1: 1}
         return candidate_mapping, weight_dict
 
     @staticmethod
-    def smart_init_mapping(candidate_mapping, instance1, instance2):
+    def smart_init_mapping(candidate_mapping, instance1, instance2, rng=None):
         """
         Initialize mapping based on the concept mapping (smart initialization)
         Arguments:
             candidate_mapping: candidate node match list
             instance1: instance triples of AMR 1
             instance2: instance triples of AMR 2
+            rng: random.Random to use (module random with a fresh seed by default)
         Returns:
             initialized node mapping between two AMRs
 
         """
-        random.seed()
+        return SmatchScript.smart_init_mapping_from_values(candidate_mapping, [t[2] for t in instance1],
+                                                           [t[2] for t in instance2], rng=rng)
+
+    @staticmethod
+    def smart_init_mapping_from_values(candidate_mapping, values1, values2, rng=None):
+        """
+        Smart initialization (see smart_init_mapping) from node values (concepts) of AMR 1 and AMR 2,
+        strings or any other values equal exactly when the concepts are (e.g. symbol ids).
+
+        """
+        if rng is None:
+            random.seed()
+            rng = random
         matched_dict = {}
         result = []
         # list to store node indices that have no concept match
@@ -393,9 +954,9 @@ class SmatchScript:
                 result.append(-1)
                 continue
             # node value in instance triples of AMR 1
-            value1 = instance1[i][2]
+            value1 = values1[i]
             for node_index in candidates:
-                value2 = instance2[node_index][2]
+                value2 = values2[node_index]
                 # find the first instance triple match in the candidates
                 # instance triple match is having the same concept value
                 if value1 == value2:
@@ -411,7 +972,7 @@ class SmatchScript:
             candidates = list(candidate_mapping[i])
             while len(candidates) > 0:
                 # get a random node index from candidates
-                rid = random.randint(0, len(candidates) - 1)
+                rid = rng.randint(0, len(candidates) - 1)
                 if candidates[rid] in matched_dict:
                     candidates.pop(rid)
                 else:
@@ -421,17 +982,20 @@ class SmatchScript:
         return result
 
     @staticmethod
-    def random_init_mapping(candidate_mapping):
+    def random_init_mapping(candidate_mapping, rng=None):
         """
         Generate a random node mapping.
         Args:
             candidate_mapping: candidate_mapping: candidate node match list
+            rng: random.Random to use (module random with a fresh seed by default)
         Returns:
             randomly-generated node mapping between two AMRs
 
         """
         # if needed, a fixed seed could be passed here to generate same random (to help debugging)
-        random.seed()
+        if rng is None:
+            random.seed()
+            rng = random
         matched_dict = {}
         result = []
         for c in candidate_mapping:
@@ -443,7 +1007,7 @@ class SmatchScript:
             found = False
             while len(candidates) > 0:
                 # randomly generate an index in [0, length of candidates)
-                rid = random.randint(0, len(candidates) - 1)
+                rid = rng.randint(0, len(candidates) - 1)
                 # check if it has already been matched
                 if candidates[rid] in matched_dict:
                     candidates.pop(rid)
@@ -471,10 +1035,13 @@ class SmatchScript:
         if self.veryVerbose:
             logger.info("Computing match for mapping")
             logger.info(mapping)
-        if tuple(mapping) in self.match_triple_dict:
+        self.prepare_mapping_hash(len(mapping), max(mapping) + 1 if mapping else 0)
+        mapping_hash = self.mapping_hash(mapping)
+        saved_match_num = self.match_triple_dict.get(mapping_hash)
+        if saved_match_num is not None:
             if self.veryVerbose:
-                logger.info("saved value", self.match_triple_dict[tuple(mapping)])
-            return self.match_triple_dict[tuple(mapping)]
+                logger.info("saved value", saved_match_num)
+            return saved_match_num
         match_num = 0
         # i is node index in AMR 1, m is node index in AMR 2
         for i, m in enumerate(mapping):
@@ -505,10 +1072,35 @@ class SmatchScript:
         if self.veryVerbose:
             logger.info("match computing complete, result:", match_num)
         # update match_triple_dict
-        self.match_triple_dict[tuple(mapping)] = match_num
+        self.match_triple_dict.put(mapping_hash, match_num)
         return match_num
 
-    def move_gain(self, mapping, node_id, old_id, new_id, weight_dict, match_num):
+    def prepare_mapping_hash(self, node_num1, node_num2):
+        """
+        Make sure Zobrist keys exist for all node pairs of AMRs with node_num1 and node_num2 nodes.
+
+        """
+        keys = self.zobrist_keys
+        while len(keys) < node_num1:
+            keys.append([])
+        for i in range(node_num1):
+            row = keys[i]
+            while len(row) <= node_num2:
+                row.append(self._zobrist_random.getrandbits(64))
+
+    def mapping_hash(self, mapping):
+        """
+        Zobrist hash of a node mapping. A move or a swap changes it by xor-ing out the keys of the old node pairs
+        and xor-ing in the keys of the new ones, so hashes of neighbouring mappings are computed in O(1).
+
+        """
+        mapping_hash = 0
+        keys = self.zobrist_keys
+        for i, m in enumerate(mapping):
+            mapping_hash ^= keys[i][m + 1]
+        return mapping_hash
+
+    def move_gain(self, mapping, node_id, old_id, new_id, weight_dict, match_num, mapping_hash=None):
         """
         Compute the triple match number gain from the move operation
         Arguments:
@@ -518,6 +1110,7 @@ class SmatchScript:
             new_id: new node in to which node_id is mapped
             weight_dict: weight dictionary
             match_num: the original triple matching number
+            mapping_hash: hash of the current node mapping (computed if not given)
         Returns:
             the triple match gain number (might be negative)
 
@@ -526,34 +1119,38 @@ class SmatchScript:
         new_mapping = (node_id, new_id)
         # node mapping before moving
         old_mapping = (node_id, old_id)
-        # new nodes mapping list (all node pairs)
-        new_mapping_list = mapping[:]
-        new_mapping_list[node_id] = new_id
+        # hash of the new nodes mapping list (all node pairs), the list itself is not built
+        if mapping_hash is None:
+            mapping_hash = self.mapping_hash(mapping)
+        keys = self.zobrist_keys[node_id]
+        new_mapping_hash = mapping_hash ^ keys[old_id + 1] ^ keys[new_id + 1]
         # if this mapping is already been investigated, use saved one to avoid duplicate computing
-        if tuple(new_mapping_list) in self.match_triple_dict:
-            return self.match_triple_dict[tuple(new_mapping_list)] - match_num
+        saved_match_num = self.match_triple_dict.get(new_mapping_hash)
+        if saved_match_num is not None:
+            return saved_match_num - match_num
         gain = 0
         # add the triple match incurred by new_mapping to gain
         if new_mapping in weight_dict:
-            for key in weight_dict[new_mapping]:
+            for key, weight in weight_dict[new_mapping].items():
                 if key == -1:
                     # instance/attribute triple match
-                    gain += weight_dict[new_mapping][-1]
-                elif new_mapping_list[key[0]] == key[1]:
-                    # relation gain incurred by new_mapping and another node pair in new_mapping_list
-                    gain += weight_dict[new_mapping][key]
+                    gain += weight
+                elif (new_id if key[0] == node_id else mapping[key[0]]) == key[1]:
+                    # relation gain incurred by new_mapping and another node pair in the new mapping
+                    gain += weight
         # deduct the triple match incurred by old_mapping from gain
         if old_mapping in weight_dict:
-            for k in weight_dict[old_mapping]:
+            for k, weight in weight_dict[old_mapping].items():
                 if k == -1:
-                    gain -= weight_dict[old_mapping][-1]
+                    gain -= weight
                 elif mapping[k[0]] == k[1]:
-                    gain -= weight_dict[old_mapping][k]
+                    gain -= weight
         # update match number dictionary
-        self.match_triple_dict[tuple(new_mapping_list)] = match_num + gain
+        self.match_triple_dict.put(new_mapping_hash, match_num + gain)
         return gain
 
-    def swap_gain(self, mapping, node_id1, mapping_id1, node_id2, mapping_id2, weight_dict, match_num):
+    def swap_gain(self, mapping, node_id1, mapping_id1, node_id2, mapping_id2, weight_dict, match_num,
+                  mapping_hash=None):
         """
         Compute the triple match number gain from the swapping
         Arguments:
@@ -564,17 +1161,22 @@ class SmatchScript:
         mapping_id2: the node index in AMR 2 node 2 maps to (in the current mapping)
         weight_dict: weight dictionary
         match_num: the original matching triple number
+        mapping_hash: hash of the current node mapping (computed if not given)
         Returns:
         the gain number (might be negative)
 
         """
-        new_mapping_list = mapping[:]
         # Before swapping, node_id1 maps to mapping_id1, and node_id2 maps to mapping_id2
         # After swapping, node_id1 maps to mapping_id2 and node_id2 maps to mapping_id1
-        new_mapping_list[node_id1] = mapping_id2
-        new_mapping_list[node_id2] = mapping_id1
-        if tuple(new_mapping_list) in self.match_triple_dict:
-            return self.match_triple_dict[tuple(new_mapping_list)] - match_num
+        if mapping_hash is None:
+            mapping_hash = self.mapping_hash(mapping)
+        keys1 = self.zobrist_keys[node_id1]
+        keys2 = self.zobrist_keys[node_id2]
+        new_mapping_hash = (mapping_hash ^ keys1[mapping_id1 + 1] ^ keys1[mapping_id2 + 1]
+                            ^ keys2[mapping_id2 + 1] ^ keys2[mapping_id1 + 1])
+        saved_match_num = self.match_triple_dict.get(new_mapping_hash)
+        if saved_match_num is not None:
+            return saved_match_num - match_num
         gain = 0
         new_mapping1 = (node_id1, mapping_id2)
         new_mapping2 = (node_id2, mapping_id1)
@@ -586,36 +1188,37 @@ class SmatchScript:
             old_mapping1 = (node_id2, mapping_id2)
             old_mapping2 = (node_id1, mapping_id1)
         if new_mapping1 in weight_dict:
-            for key in weight_dict[new_mapping1]:
+            for key, weight in weight_dict[new_mapping1].items():
                 if key == -1:
-                    gain += weight_dict[new_mapping1][-1]
-                elif new_mapping_list[key[0]] == key[1]:
-                    gain += weight_dict[new_mapping1][key]
+                    gain += weight
+                elif (mapping_id2 if key[0] == node_id1 else
+                      mapping_id1 if key[0] == node_id2 else mapping[key[0]]) == key[1]:
+                    gain += weight
         if new_mapping2 in weight_dict:
-            for key in weight_dict[new_mapping2]:
+            for key, weight in weight_dict[new_mapping2].items():
                 if key == -1:
-                    gain += weight_dict[new_mapping2][-1]
+                    gain += weight
                 # to avoid duplicate
                 elif key[0] == node_id1:
                     continue
-                elif new_mapping_list[key[0]] == key[1]:
-                    gain += weight_dict[new_mapping2][key]
+                elif (mapping_id1 if key[0] == node_id2 else mapping[key[0]]) == key[1]:
+                    gain += weight
         if old_mapping1 in weight_dict:
-            for key in weight_dict[old_mapping1]:
+            for key, weight in weight_dict[old_mapping1].items():
                 if key == -1:
-                    gain -= weight_dict[old_mapping1][-1]
+                    gain -= weight
                 elif mapping[key[0]] == key[1]:
-                    gain -= weight_dict[old_mapping1][key]
+                    gain -= weight
         if old_mapping2 in weight_dict:
-            for key in weight_dict[old_mapping2]:
+            for key, weight in weight_dict[old_mapping2].items():
                 if key == -1:
-                    gain -= weight_dict[old_mapping2][-1]
+                    gain -= weight
                 # to avoid duplicate
                 elif key[0] == node_id1:
                     continue
                 elif mapping[key[0]] == key[1]:
-                    gain -= weight_dict[old_mapping2][key]
-        self.match_triple_dict[tuple(new_mapping_list)] = match_num + gain
+                    gain -= weight
+        self.match_triple_dict.put(new_mapping_hash, match_num + gain)
         return gain
 
     def get_best_gain(self, mapping, candidate_mappings, weight_dict, instance_len, cur_match_num):
@@ -646,6 +1249,8 @@ class SmatchScript:
         for nid in mapping:
             if nid in unmatched:
                 unmatched.remove(nid)
+        # hashes of the new mappings are derived from the hash of the current one
+        mapping_hash = self.mapping_hash(mapping)
         for i, nid in enumerate(mapping):
             # current node i in AMR 1 maps to node nid in AMR 2
             for nm in unmatched:
@@ -654,7 +1259,7 @@ class SmatchScript:
                     # (i, m) -> (i, nm)
                     if self.veryVerbose:
                         logger.info("Remap node", i, "from ", nid, "to", nm)
-                    mv_gain = self.move_gain(mapping, i, nid, nm, weight_dict, cur_match_num)
+                    mv_gain = self.move_gain(mapping, i, nid, nm, weight_dict, cur_match_num, mapping_hash)
                     if self.veryVerbose:
                         logger.info("Move gain:", mv_gain)
                         new_mapping = mapping[:]
@@ -679,7 +1284,7 @@ class SmatchScript:
                     logger.info("Before swapping:", i, "-", m, ",", j, "-", m2)
                     logger.info(mapping)
                     logger.info("After swapping:", i, "-", m2, ",", j, "-", m)
-                sw_gain = self.swap_gain(mapping, i, m, j, m2, weight_dict, cur_match_num)
+                sw_gain = self.swap_gain(mapping, i, m, j, m2, weight_dict, cur_match_num, mapping_hash)
                 if self.veryVerbose:
                     logger.info("Swap gain:", sw_gain)
                     new_mapping = mapping[:]
@@ -763,24 +1368,48 @@ class SmatchScript:
                 logger.info("F-score:", "0.0")
             return precision, recall, 0.00
 
+    def get_pair_random(self, cur_amr1, cur_amr2):
+        """
+        Random state for one AMR pair. With a fixed seed it depends only on the seed and the pair itself,
+        so scores do not depend on the order (or the process) AMR pairs are scored in.
+        Returns None (fresh random state) when no seed is given.
+
+        """
+        if self.seed is None:
+            return None
+        return random.Random("{0}\t{1}\t{2}".format(self.seed, cur_amr1, cur_amr2))
+
     def process_instance(self, cur_amr1, cur_amr2):
+        """
+        Score one AMR pair (AMR 1 is the test one, AMR 2 is the gold one) and accumulate the result.
 
+        """
+        self.add_instance_score(*self.score_instance(cur_amr1, cur_amr2))
+
+    def score_instance(self, cur_amr1, cur_amr2):
+        """
+        Score one AMR pair without accumulating the result.
+        Returns:
+            best_match_num: matching triple number
+            test_triple_num: triple number of AMR 1
+            gold_triple_num: triple number of AMR 2
+            followed by the fine-grained counts (see fine_grained_counts) if fine_grained is set
+
+        """
         # make sure one_line format is given
         cur_amr1 = cur_amr1.replace("\n", "")
         cur_amr2 = cur_amr2.replace("\n", "")
+        # no prepared AMRs are in use between pairs, so the symbol table can be reset here
+        amr.trim_symbols()
 
-        amr1 = amr.AMR.parse_AMR_line(cur_amr1)
-        amr2 = amr.AMR.parse_AMR_line(cur_amr2)
+        scores = self.lookup_score(cur_amr1, cur_amr2)
+        if scores is not None:
+            return scores
 
-        prefix1 = "a"
-        prefix2 = "b"
         # Rename node to "a1", "a2", .etc
-
-        amr1.rename_node(prefix1)
+        prepared1 = PreparedAMR(cur_amr1, "a")
         # Renaming node to "b1", "b2", .etc
-        amr2.rename_node(prefix2)
-        (instance1, attributes1, relation1) = amr1.get_triples()
-        (instance2, attributes2, relation2) = amr2.get_triples()
+        prepared2 = self.prepare_gold_amr(cur_amr2)
 
         if self.verbose:
             # print parse results of two AMRs
@@ -788,38 +1417,308 @@ class SmatchScript:
             logger.info("============================================")
             logger.info("AMR 1 (one-line):", cur_amr1)
             logger.info("AMR 2 (one-line):", cur_amr2)
+            instance1, attribute1, relation1 = prepared1.triples()
+            instance2, attribute2, relation2 = prepared2.triples()
             logger.info("Instance triples of AMR 1:", len(instance1))
             logger.info(instance1)
-            logger.info("Attribute triples of AMR 1:", len(attributes1))
-            logger.info(attributes1)
+            logger.info("Attribute triples of AMR 1:", len(attribute1))
+            logger.info(attribute1)
             logger.info("Relation triples of AMR 1:", len(relation1))
             logger.info(relation1)
             logger.info("Instance triples of AMR 2:", len(instance2))
             logger.info(instance2)
-            logger.info("Attribute triples of AMR 2:", len(attributes2))
-            logger.info(attributes2)
+            logger.info("Attribute triples of AMR 2:", len(attribute2))
+            logger.info(attribute2)
             logger.info("Relation triples of AMR 2:", len(relation2))
             logger.info(relation2)
-        (best_mapping, best_match_num) = self.get_best_match(instance1, attributes1, relation1,
-                                                             instance2, attributes2, relation2,
-                                                             prefix1, prefix2, doinstance=self.doinstance,
-                                                             doattribute=self.doattribute, dorelation=self.dorelation)
+        scores = self.score_prepared(prepared1, prepared2, rng=self.get_pair_random(cur_amr1, cur_amr2))
+        self.store_score(cur_amr1, cur_amr2, scores)
+        return scores
+
+    def score_many(self, predictions, gold):
+        """
+        Score several test AMRs (e.g. n-best candidates) against one gold AMR without accumulating the results.
+        The gold AMR is parsed and indexed once, identical test AMRs are scored once.
+        Scores are the same as of score_instance of every pair.
+        Returns:
+            list of scores (see score_instance) of every test AMR
+
+        """
+        gold = gold.replace("\n", "")
+        amr.trim_symbols()
+        prepared2 = None
+        unique_scores = {}
+        scores = []
+        for prediction in predictions:
+            prediction = prediction.replace("\n", "")
+            if prediction not in unique_scores:
+                pair_scores = self.lookup_score(prediction, gold)
+                if pair_scores is None:
+                    if prepared2 is None:
+                        prepared2 = self.prepare_gold_amr(gold)
+                    pair_scores = self.score_prepared(PreparedAMR(prediction, "a"), prepared2,
+                                                      rng=self.get_pair_random(prediction, gold))
+                    self.store_score(prediction, gold, pair_scores)
+                unique_scores[prediction] = pair_scores
+            scores.append(unique_scores[prediction])
+        return scores
+
+    def score_against_references(self, prediction, golds):
+        """
+        Score one test AMR against several gold AMRs (e.g. of different annotators) without accumulating the results.
+        The test AMR is parsed and indexed once, identical gold AMRs are scored once.
+        Scores are the same as of score_instance of every pair.
+        Returns:
+            list of scores (see score_instance) against every gold AMR
+
+        """
+        prediction = prediction.replace("\n", "")
+        amr.trim_symbols()
+        prepared1 = None
+        unique_scores = {}
+        scores = []
+        for gold in golds:
+            gold = gold.replace("\n", "")
+            if gold not in unique_scores:
+                pair_scores = self.lookup_score(prediction, gold)
+                if pair_scores is None:
+                    if prepared1 is None:
+                        prepared1 = PreparedAMR(prediction, "a")
+                    pair_scores = self.score_prepared(prepared1, self.prepare_gold_amr(gold),
+                                                      rng=self.get_pair_random(prediction, gold))
+                    self.store_score(prediction, gold, pair_scores)
+                unique_scores[gold] = pair_scores
+            scores.append(unique_scores[gold])
+        return scores
+
+    def pairwise_f_scores(self, amrs):
+        """
+        Smatch F-scores of every pair of the AMRs (e.g. n-best candidates, for consensus selection).
+        Every AMR is parsed once and every unordered pair is aligned once, the F-score of (i, j)
+        is used for (j, i) too. Identical AMRs score 1 without alignment.
+        Returns:
+            symmetric matrix (list of lists) of F-scores
+
+        """
+        amrs = [cur_amr.replace("\n", "") for cur_amr in amrs]
+        amr.trim_symbols()
+        unique_amrs = list(OrderedDict.fromkeys(amrs))
+        position = {cur_amr: k for k, cur_amr in enumerate(unique_amrs)}
+        prepared_test = [PreparedAMR(cur_amr, "a") for cur_amr in unique_amrs]
+        prepared_gold = [PreparedAMR(cur_amr, "b") for cur_amr in unique_amrs[1:]]
+        f_scores = [[1.0] * len(unique_amrs) for _ in unique_amrs]
+        for i in range(len(unique_amrs)):
+            for j in range(i + 1, len(unique_amrs)):
+                scores = self.score_prepared(prepared_test[i], prepared_gold[j - 1],
+                                             rng=self.get_pair_random(unique_amrs[i], unique_amrs[j]))
+                f_scores[i][j] = f_scores[j][i] = self.compute_f(*scores[:3])[2]
+        return [[f_scores[position[cur_amr1]][position[cur_amr2]] for cur_amr2 in amrs] for cur_amr1 in amrs]
+
+    def score_settings(self):
+        """
+        String describing settings which influence the score of an AMR pair (used in score cache keys).
+
+        """
+        settings = "r{0}-i{1}-a{2}-rel{3}-s{4}".format(self.iteration_num, int(self.justinstance),
+                                                       int(self.justattribute), int(self.justrelation), self.seed)
+        # the upper bound early stop is exact, only the budget and the exact search can change scores
+        if self.max_time is not None or self.max_steps is not None:
+            settings += "-t{0}-n{1}".format(self.max_time, self.max_steps)
+        if self.exact_threshold:
+            settings += "-x{0}".format(self.exact_threshold)
+        if self.fine_grained:
+            settings += "-fg"
+        return settings
+
+    def lookup_score(self, cur_amr1, cur_amr2):
+        """
+        Return cached scores of the AMR pair (see score_instance) or None.
+
+        """
+        if self.score_cache is None:
+            return None
+        key = self.score_cache.make_key(cur_amr1.replace("\n", ""), cur_amr2.replace("\n", ""),
+                                        self.score_settings())
+        return self.score_cache.get(key)
+
+    def store_score(self, cur_amr1, cur_amr2, scores):
+        """
+        Put scores of the AMR pair into the score cache (if enabled).
+
+        """
+        if self.score_cache is None:
+            return
+        key = self.score_cache.make_key(cur_amr1.replace("\n", ""), cur_amr2.replace("\n", ""),
+                                        self.score_settings())
+        self.score_cache.put(key, scores)
+
+    def prepare_gold_amr(self, cur_amr2):
+        """
+        Get PreparedAMR of a gold AMR, from the gold cache if it is enabled.
+
+        """
+        if self.gold_cache is None:
+            return PreparedAMR(cur_amr2, "b")
+        key = hashlib.sha1(cur_amr2.encode('utf-8')).digest()
+        prepared2 = self.gold_cache.get(key)
+        # AMRs prepared before the symbol table was reset (see amr.trim_symbols) are prepared again
+        if prepared2 is None or prepared2.generation != amr.SYMBOLS.generation:
+            prepared2 = PreparedAMR(cur_amr2, "b")
+            self.gold_cache.put(key, prepared2)
+        return prepared2
+
+    def score_prepared(self, prepared1, prepared2, rng=None):
+        """
+        Score a pair of prepared AMRs (see PreparedAMR) without accumulating the result.
+        Returns:
+            best_match_num: matching triple number
+            test_triple_num: triple number of AMR 1
+            gold_triple_num: triple number of AMR 2
+            followed by the fine-grained counts (see fine_grained_counts) if fine_grained is set
+
+        """
+        index1, index2 = prepared1.index, prepared2.index
+        # raw concept ids are equal exactly when the concepts are, so they serve as node values of the smart init
+        (best_mapping, best_match_num) = self.get_best_match_from_index(index1, index2, prepared1.graph.concepts,
+                                                                        prepared2.graph.concepts,
+                                                                        doinstance=self.doinstance,
+                                                                        doattribute=self.doattribute,
+                                                                        dorelation=self.dorelation, rng=rng)
         if self.verbose:
             logger.info("best match number", best_match_num)
             logger.info("best node mapping", best_mapping)
-            logger.info("Best node mapping alignment:", self.print_alignment(best_mapping, instance1, instance2))
+            logger.info("Best node mapping alignment:",
+                        self.print_alignment(best_mapping, prepared1.triples()[0], prepared2.triples()[0]))
         if self.justinstance:
-            test_triple_num = len(instance1)
-            gold_triple_num = len(instance2)
+            test_triple_num = len(index1.instances)
+            gold_triple_num = len(index2.instances)
         elif self.justattribute:
-            test_triple_num = len(attributes1)
-            gold_triple_num = len(attributes2)
+            test_triple_num = len(index1.attributes)
+            gold_triple_num = len(index2.attributes)
         elif self.justrelation:
-            test_triple_num = len(relation1)
-            gold_triple_num = len(relation2)
+            test_triple_num = len(index1.relations)
+            gold_triple_num = len(index2.relations)
         else:
-            test_triple_num = len(instance1) + len(attributes1) + len(relation1)
-            gold_triple_num = len(instance2) + len(attributes2) + len(relation2)
+            test_triple_num = len(index1.instances) + len(index1.attributes) + len(index1.relations)
+            gold_triple_num = len(index2.instances) + len(index2.attributes) + len(index2.relations)
+        # clear the matching triple dictionary for the next AMR pair
+        self.match_triple_dict.clear()
+        if self.fine_grained:
+            return ((best_match_num, test_triple_num, gold_triple_num)
+                    + self.fine_grained_counts(best_mapping, prepared1.index, prepared2.index))
+        return best_match_num, test_triple_num, gold_triple_num
+
+    @staticmethod
+    def fine_grained_counts(mapping, index1, index2):
+        """
+        Fine-grained sub-scores of an AMR pair under the given node mapping (no re-alignment):
+            Unlabeled: all triples, relation and attribute names are ignored
+            No WSD: all triples, sense tags of concepts (e.g. -01) are ignored
+            Concepts: instance triples
+            NER: concepts of named entities (nodes with a :name relation)
+            Negations: :polarity - attributes
+            Wikification: :wiki attributes
+            Reentrancies: relation triples pointing to nodes with more than one incoming relation
+            SRL: :ARGn relation triples
+        Triples are matched one-to-one (as long as neither AMR repeats a triple, this is the same as in compute_pool),
+        so e.g. two attributes with the same value of one node are not both matched twice when names are ignored.
+        Arguments:
+            mapping: node mapping, the ith entry is the node index in AMR 2 which maps to the ith node in AMR 1
+            index1: TripleIndex of AMR 1
+            index2: TripleIndex of AMR 2
+        Returns:
+            flat tuple of (match number, test triple number, gold triple number) of every FINE_GRAINED_NAMES entry
+
+        """
+        # labels are normalized symbol ids (see TripleIndex)
+        names = amr.SYMBOLS.names
+        label = amr.SYMBOLS.normalized_id
+        name_label, wiki_label = label("name"), label("wiki")
+        negation_label = (label("polarity"), label("-"))
+
+        def mapped(node):
+            return mapping[node] if node < len(mapping) else -1
+
+        def remove_sense(concept):
+            return re.sub(r'-\d\d$', '', names[concept])
+
+        def is_srl(relation):
+            return re.match(r'^arg\d+$', names[relation]) is not None
+
+        def count(items1, items2, key1, key2):
+            # key1 gives the key of an item of AMR 1 in terms of AMR 2 nodes (None if it can not match)
+            counter1 = Counter(key1(item) for item in items1)
+            counter2 = Counter(key2(item) for item in items2)
+            match_num = sum(min(num, counter2[key]) for key, num in counter1.items() if key is not None)
+            return match_num, len(items1), len(items2)
+
+        def concepts(index):
+            return index.instances
+
+        def reentrant(index):
+            incoming = Counter(node2 for _, _, node2 in index.relations)
+            return [relation for relation in index.relations if incoming[relation[2]] > 1]
+
+        def named(index):
+            named_nodes = set(node1 for relation, node1, _ in index.relations if relation == name_label)
+            concept = dict((node, concept) for concept, node in index.instances)
+            return [(concept[node], node) for node in named_nodes if node in concept]
+
+        def unary_key(item):
+            node = mapped(item[1])
+            return None if node == -1 else (item[0], node)
+
+        def relation_key(item):
+            node1, node2 = mapped(item[1]), mapped(item[2])
+            return None if node1 == -1 or node2 == -1 else (item[0], node1, node2)
+
+        def unlabeled_relation_key(item):
+            key = relation_key(item)
+            return None if key is None else key[1:]
+
+        def identity(item):
+            return item
+
+        def unlabeled(item):
+            return item[1:]
+
+        def value_key(item):
+            node = mapped(item[1])
+            return None if node == -1 else (item[0][1], node)
+
+        def value(item):
+            return item[0][1], item[1]
+
+        concepts1, concepts2 = concepts(index1), concepts(index2)
+        concept_counts = count(concepts1, concepts2, unary_key, identity)
+        attribute_counts = count(index1.attributes, index2.attributes, unary_key, identity)
+        relation_counts = count(index1.relations, index2.relations, relation_key, identity)
+
+        unlabeled_counts = [sum(triple_counts) for triple_counts in zip(
+            concept_counts,
+            count(index1.attributes, index2.attributes, value_key, value),
+            count(index1.relations, index2.relations, unlabeled_relation_key, unlabeled))]
+        no_wsd_concepts = count([(remove_sense(concept), node) for concept, node in concepts1],
+                                [(remove_sense(concept), node) for concept, node in concepts2], unary_key, identity)
+        no_wsd_counts = [sum(triple_counts) for triple_counts in zip(no_wsd_concepts, attribute_counts,
+                                                                     relation_counts)]
+        ner_counts = count(named(index1), named(index2), unary_key, identity)
+        negation_counts = count([a for a in index1.attributes if a[0] == negation_label],
+                                [a for a in index2.attributes if a[0] == negation_label], unary_key, identity)
+        wiki_counts = count([a for a in index1.attributes if a[0][0] == wiki_label],
+                            [a for a in index2.attributes if a[0][0] == wiki_label], unary_key, identity)
+        reentrancy_counts = count(reentrant(index1), reentrant(index2), relation_key, identity)
+        srl_counts = count([r for r in index1.relations if is_srl(r[0])],
+                           [r for r in index2.relations if is_srl(r[0])], relation_key, identity)
+        return (tuple(unlabeled_counts) + tuple(no_wsd_counts) + concept_counts + ner_counts + negation_counts
+                + wiki_counts + reentrancy_counts + srl_counts)
+
+    def add_instance_score(self, best_match_num, test_triple_num, gold_triple_num, *fine_scores):
+        """
+        Accumulate the score of one AMR pair (see score_instance).
+        fine_scores: flat fine-grained counts of the pair (see fine_grained_counts), if enabled
+
+        """
         if not self.single_score:
             # if each AMR pair should have a score, compute and output it here
             (precision, recall, best_f_score) = self.compute_f(best_match_num,
@@ -827,21 +1726,31 @@ class SmatchScript:
                                                                gold_triple_num)
             # print "Sentence", sent_num
             if self.pr_flag:
-                print("Precision: " + self.floatdisplay % precision)
-                print("Recall: " + self.floatdisplay % recall)
-            print("F-score: " + self.floatdisplay % best_f_score)
-        self.total_match_num += best_match_num
-        self.total_test_num += test_triple_num
-        self.total_gold_num += gold_triple_num
-        # clear the matching triple dictionary for the next AMR pair
-        self.match_triple_dict.clear()
-        self.sent_num += 1
+                print("Precision: " + self.floatdisplay % precision, file=self.out)
+                print("Recall: " + self.floatdisplay % recall, file=self.out)
+            print("F-score: " + self.floatdisplay % best_f_score, file=self.out)
+        self.counts.add(best_match_num, test_triple_num, gold_triple_num)
+        if self.keep_pair_counts:
+            self._pair_counts.extend((best_match_num, test_triple_num, gold_triple_num))
+        if self.fine_counts is not None and fine_scores:
+            for k, counts in enumerate(self.fine_counts.values()):
+                counts.add(*fine_scores[3 * k:3 * k + 3])
+
+    def add_search_stats(self, search_stats):
+        """
+        Add search stats counted by another SmatchScript (e.g. of a worker process, see score_worker).
+
+        """
+        for stop_reason, count in search_stats.items():
+            self.search_stats[stop_reason] += count
 
     def report(self):
 
         if self.verbose:
             logger.info("Total match number, total triple number in AMR 1, and total triple number in AMR 2:")
             logger.info(self.total_match_num, self.total_test_num, self.total_gold_num)
+            logger.info("Mapping search stats: %s", self.search_stats)
+            logger.info("AMR parse cache: %s", amr.parse_cache_info())
             logger.info("---------------------------------------------------------------------------------")
         # output document-level smatch score (a single f-score for all AMR pairs in two files)
 
@@ -851,19 +1760,26 @@ class SmatchScript:
             (precision, recall, best_f_score) = self.compute_f(self.total_match_num, self.total_test_num,
                                                                self.total_gold_num)
 
-            print(self.total_match_num, self.total_test_num, self.total_gold_num)
+            print(self.total_match_num, self.total_test_num, self.total_gold_num, file=self.out)
             if self.pr_flag:
-                print("Precision: " + self.floatdisplay % precision)
-                print("Recall: " + self.floatdisplay % recall)
+                print("Precision: " + self.floatdisplay % precision, file=self.out)
+                print("Recall: " + self.floatdisplay % recall, file=self.out)
             # print('Total AMRs: {0}'.format(len(gold_amrs)))
-            print("Document F-score: " + self.floatdisplay % best_f_score)
+            print("Document F-score: " + self.floatdisplay % best_f_score, file=self.out)
+            if self.fine_counts is not None:
+                for name, counts in self.fine_counts.items():
+                    (precision, recall, f_score) = self.compute_f(counts.match_num, counts.test_num,
+                                                                  counts.gold_num)
+                    print("{0} -> P: {1}, R: {2}, F: {3}".format(name, self.floatdisplay % precision,
+                                                                 self.floatdisplay % recall,
+                                                                 self.floatdisplay % f_score), file=self.out)
 
     def get_metrics(self):
         precision, recall, best_f_score = self.compute_f(self.total_match_num,
                                                          self.total_test_num,
                                                          self.total_gold_num)
 
-        return {
+        metrics = {
             # "total_match_num": self.total_match_num,
             # "total_test_num": self.total_test_num,
             # "total_gold_num": self.total_gold_num,
@@ -871,6 +1787,127 @@ class SmatchScript:
             "Recall": recall,
             "SMATCH": best_f_score
         }
+        if self.fine_counts is not None:
+            for name, counts in self.fine_counts.items():
+                metrics[name] = self.compute_f(counts.match_num, counts.test_num, counts.gold_num)[2]
+        return metrics
+
+
+# SmatchScript of a worker process, see init_worker
+_worker_state = None
+
+
+def make_gold_cache(max_size, max_bytes=None):
+    """
+    Cache of PreparedAMR objects of gold AMRs (see SmatchScript.prepare_gold_amr).
+    max_size: maximal number of cached AMRs, 0 disables the cache (None is returned)
+    max_bytes: maximal estimated memory of cached AMRs (see PreparedAMR.estimated_size), None for no limit
+
+    """
+    if max_size <= 0:
+        return None
+    return LRUCache(max_size, max_bytes=max_bytes, size_of=PreparedAMR.estimated_size)
+
+
+def init_worker(script_kwargs, gold_cache_size=0, gold_cache_bytes=None):
+    """
+    Initializer of worker processes scoring AMR pairs in parallel.
+    script_kwargs: keyword arguments of SmatchScript
+    gold_cache_size, gold_cache_bytes: limits of the gold AMR cache of the worker (see make_gold_cache)
+
+    """
+    global _worker_state
+    _worker_state = SmatchScript(gold_cache=make_gold_cache(gold_cache_size, gold_cache_bytes), **script_kwargs)
+
+
+def score_worker(amr_pair):
+    """
+    Score (AMR 1, AMR 2) pair in a worker process initialized with init_worker.
+    Returns (best_match_num, test_triple_num, gold_triple_num) and the search stats of the pair
+    (see SmatchScript.add_search_stats)
+
+    """
+    scores, search_stats = score_worker_batch([amr_pair])
+    return scores[0], search_stats
+
+
+def score_worker_batch(pairs):
+    """
+    Score a list of (AMR 1, AMR 2) pairs in a worker process initialized with init_worker.
+    Returns the list of pair scores and the search stats of the pairs (see SmatchScript.add_search_stats)
+
+    """
+    stats_before = dict(_worker_state.search_stats)
+    scores = [_worker_state.score_instance(*pair) for pair in pairs]
+    search_stats = {stop_reason: count - stats_before[stop_reason]
+                    for stop_reason, count in _worker_state.search_stats.items()}
+    return scores, search_stats
+
+
+def score_worker_loop(script_kwargs, gold_cache_size, gold_cache_bytes, tasks, results):
+    """
+    Main loop of a background scoring process.
+    Takes (batch id, list of AMR pairs) tasks from the tasks queue until None is received and puts
+    (batch id, list of pair scores, search stats of the batch) to the results queue.
+    script_kwargs, gold_cache_size, gold_cache_bytes: see init_worker
+
+    """
+    init_worker(script_kwargs, gold_cache_size, gold_cache_bytes)
+    for batch_id, pairs in iter(tasks.get, None):
+        results.put((batch_id, *score_worker_batch(pairs)))
+
+
+def process_pairs_in_pool(state, pairs, pool):
+    """
+    Score AMR pairs in a pool of worker processes (initialized with init_worker) and accumulate the scores
+    in state in the order of pairs, so per-pair output (see add_instance_score) is the same as in serial scoring.
+    Search stats of the workers are added to state as well.
+    Cached scores are looked up in state, the other pairs are scheduled largest first,
+    so they do not end up as the last running tasks.
+    state: SmatchScript accumulating the scores
+    pairs: iterable of (AMR 1, AMR 2) pairs
+    pool: multiprocessing pool
+
+    """
+    pairs = list(pairs)
+    scores = [state.lookup_score(*pair) for pair in pairs]
+    todo = [k for k, pair_scores in enumerate(scores) if pair_scores is None]
+    todo.sort(key=lambda k: len(pairs[k][0]) + len(pairs[k][1]), reverse=True)
+    for k, (pair_scores, search_stats) in zip(todo, pool.imap(score_worker, [pairs[k] for k in todo])):
+        state.store_score(*pairs[k], pair_scores)
+        state.add_search_stats(search_stats)
+        scores[k] = pair_scores
+    for pair_scores in scores:
+        state.add_instance_score(*pair_scores)
+
+
+def read_amr_pairs(prod_path, gold_path, one_line='prod'):
+    """
+    Read (test AMR, gold AMR) pairs of two files lazily and in lockstep, so memory does not grow with the file size.
+    prod_path: file with test AMRs
+    gold_path: file with gold AMRs
+    one_line: which files are in one-line format (one AMR per line): "no", "prod", "gold" or "both"
+    Raises ValueError (when the shorter file ends) if the files have different numbers of AMRs.
+
+    """
+    if one_line in ('both', 'prod'):
+        prod_amrs = SmatchScript.iter_one_line_amrs(prod_path)
+    else:
+        prod_amrs = SmatchScript.iter_amr_lines(prod_path)
+    if one_line == 'both':
+        gold_amrs = SmatchScript.iter_one_line_amrs(gold_path)
+    else:
+        gold_amrs = SmatchScript.iter_amr_lines(gold_path)
+
+    missing = object()
+    for cur_amr1, cur_amr2 in zip_longest(prod_amrs, gold_amrs, fillvalue=missing):
+        if cur_amr1 is missing:
+            logger.error("Error: File 1 has less AMRs than file 2")
+            raise ValueError("File 1 has less AMRs than file 2")
+        if cur_amr2 is missing:
+            logger.error("Error: File 2 has less AMRs than file 1")
+            raise ValueError("File 2 has less AMRs than file 1")
+        yield cur_amr1, cur_amr2
 
 
 def main():
@@ -878,37 +1915,46 @@ def main():
     args = parser.parse_args()
 
     logging.critical(args)
-    state = SmatchScript(**vars(args))
-
-    if args.one_line == 'both':
-        prod_amrs = [x.strip() for x in open(args.f[0], 'r')]
-        gold_amrs = [x.strip() for x in open(args.f[1], 'r')]
-    elif args.one_line == 'prod':
-        prod_amrs = [x.strip() for x in open(args.f[0], 'r')]
-        gold_amrs = SmatchScript.get_amr_line(args.f[1])
-    elif args.one_line == 'gold':
-        prod_amrs = SmatchScript.get_amr_line(args.f[0])
-        gold_amrs = SmatchScript.get_amr_line(args.f[1])
-    elif args.one_line == 'no':
-        prod_amrs = SmatchScript.get_amr_line(args.f[0])
-        gold_amrs = SmatchScript.get_amr_line(args.f[1])
-
-    logger.info((len(gold_amrs), len(prod_amrs)))
-
-    if len(gold_amrs) > len(prod_amrs):
-        logger.error("Error: File 1 has less AMRs than file 2")
-        raise ValueError
-    if len(prod_amrs) > len(gold_amrs):
-        logger.error("Error: File 2 has less AMRs than file 1")
-        raise ValueError
+    score_cache = PairScoreCache(path=args.cache) if args.cache else None
+    # scores are written in large chunks instead of line by line
+    out = open(sys.stdout.fileno(), 'w', buffering=OUTPUT_BUFFER_SIZE, closefd=False)
+    state = SmatchScript(score_cache=score_cache, out=out, keep_pair_counts=bool(args.pair_counts_out),
+                         **vars(args))
+
+    if args.merge:
+        for counts_path in args.merge:
+            state.merge(SmatchCounts.load(counts_path))
+        state.report()
+        out.flush()
+        return
 
     from tqdm import tqdm
-    for cur_amr1, cur_amr2 in tqdm(list(zip(prod_amrs, gold_amrs)), disable=False):
-        state.process_instance(cur_amr1, cur_amr2)
-        print(state.total_match_num, state.total_test_num, state.total_gold_num)
-        # state.report()
-
+    pairs = iter(tqdm(read_amr_pairs(args.f[0], args.f[1], args.one_line), disable=args.quiet))
+    if args.jobs > 1:
+        # pairs are scored in blocks, so the whole stream is never queued in memory;
+        # scores of a pair do not depend on the process it is scored in, so the result is the same as serial
+        pool = multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(vars(args),))
+        try:
+            while True:
+                block = list(islice(pairs, args.jobs * PARALLEL_BLOCK_SIZE))
+                if not block:
+                    break
+                process_pairs_in_pool(state, block, pool)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for cur_amr1, cur_amr2 in pairs:
+            state.process_instance(cur_amr1, cur_amr2)
+
+    if score_cache is not None:
+        score_cache.close()
+    if args.counts_out:
+        state.counts.save(args.counts_out)
+    if args.pair_counts_out:
+        state.save_pair_counts(args.pair_counts_out)
     state.report()
+    out.flush()
 
 
 if __name__ == "__main__":
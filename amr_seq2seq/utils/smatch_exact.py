@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Exact branch-and-bound search of the best node mapping for smatch.
+
+Hill-climbing with random restarts only approximates the best mapping. For small graphs the best mapping can
+be found exactly: nodes of AMR 1 are assigned one by one (to one of their candidate nodes of AMR 2 or left unmapped)
+in depth-first order, and a branch is pruned as soon as an optimistic bound of its match number can not beat
+the best mapping found so far.
+
+The bound of a partial mapping is its match number plus, for every node not assigned yet, the best value of
+its still free candidates: the instance/attribute weight, the relation weights with the nodes already assigned
+and the largest relation weight with every node assigned after it. Every relation triple is counted at most once
+and injectivity is ignored, so the bound never underestimates.
+
+"""
+
+
+class ExactMatchSolver(object):
+    """
+    Branch-and-bound over the candidate pool of one AMR pair.
+    Worst-case time is exponential in the number of nodes, use it for small graphs only.
+
+    """
+
+    def __init__(self, candidate_mappings, weight_dict):
+        """
+        candidate_mappings: candidate node match list (see SmatchScript.compute_pool)
+        weight_dict: weight dictionary (see SmatchScript.compute_pool)
+
+        """
+        self.node_num = len(candidate_mappings)
+        pairs = sorted(weight_dict)
+        pair_index = {pair: q for q, pair in enumerate(pairs)}
+        self.pair_node1 = [pair[0] for pair in pairs]
+        self.pair_node2 = [pair[1] for pair in pairs]
+        # instance and attribute triple match of every candidate pair
+        self.weights = [weight_dict[pair].get(-1, 0) for pair in pairs]
+        # relation triple matches of every candidate pair: list of (other candidate pair, weight)
+        self.neighbors = [[(pair_index[key], weight) for key, weight in weight_dict[pair].items() if key != -1]
+                          for pair in pairs]
+        # candidate pairs of every node of AMR 1
+        options = [[pair_index[(i, j)] for j in sorted(candidate_mappings[i]) if (i, j) in pair_index]
+                   for i in range(self.node_num)]
+
+        # nodes with the largest possible contribution are assigned first, nodes without candidates stay unmapped
+        potential = [max([self.weights[q] + sum(weight for _, weight in self.neighbors[q]) for q in options[i]] or [0])
+                     for i in range(self.node_num)]
+        self.order = sorted((i for i in range(self.node_num) if options[i]), key=lambda i: -potential[i])
+        self.options = [options[i] for i in self.order]
+        position = {node: depth for depth, node in enumerate(self.order)}
+
+        # largest relation weights of every candidate pair with the nodes assigned after its node
+        self.later_max = []
+        for q, neighbors in enumerate(self.neighbors):
+            node_position = position.get(self.pair_node1[q], -1)
+            best_weights = {}
+            for other, weight in neighbors:
+                other_node = self.pair_node1[other]
+                if position.get(other_node, -1) > node_position and weight > best_weights.get(other_node, 0):
+                    best_weights[other_node] = weight
+            self.later_max.append(sum(best_weights.values()))
+
+        self.complete = False
+
+    def solve(self, mapping=None, match_num=0, budget=None, upper_bound=None, max_nodes=None):
+        """
+        Find the node mapping with the highest triple match number.
+        Arguments:
+            mapping: best known node mapping (e.g. found by hill-climbing), used to prune the search
+            match_num: triple match number of this mapping
+            budget: SearchBudget, every search node spends one step (optional)
+            upper_bound: the search stops when this triple match number is reached (optional)
+            max_nodes: give up after this number of search nodes (optional)
+        Returns:
+            the best node mapping found and its triple match number.
+            The mapping is optimal if the search was complete (self.complete), i.e. no limit was hit.
+
+        """
+        self._mapping = [-1] * self.node_num
+        self._used = set()
+        # relation weights of every candidate pair with the nodes assigned so far
+        self._assigned_weights = [0] * len(self.weights)
+        self._best_mapping = list(mapping) if mapping is not None else [-1] * self.node_num
+        self._best_num = match_num if mapping is not None else 0
+        self._target = upper_bound
+        self._budget = budget
+        self._nodes_left = max_nodes
+        self._stopped = False
+        if upper_bound is None or self._best_num < upper_bound:
+            self._search(0, 0)
+        self.complete = not self._stopped or (upper_bound is not None and self._best_num >= upper_bound)
+        return self._best_mapping, self._best_num
+
+    def _search(self, depth, match_num):
+        if match_num > self._best_num:
+            self._best_num = match_num
+            self._best_mapping = self._mapping[:]
+            if self._target is not None and match_num >= self._target:
+                self._stopped = True
+                return
+        if depth == len(self.order):
+            return
+        if self._nodes_left is not None:
+            if self._nodes_left <= 0:
+                self._stopped = True
+                return
+            self._nodes_left -= 1
+        if self._budget is not None and not self._budget.step():
+            self._stopped = True
+            return
+
+        weights = self.weights
+        assigned_weights = self._assigned_weights
+        later_max = self.later_max
+        pair_node2 = self.pair_node2
+        used = self._used
+        bound = match_num
+        for options in self.options[depth:]:
+            best = 0
+            for q in options:
+                if pair_node2[q] not in used:
+                    value = weights[q] + assigned_weights[q] + later_max[q]
+                    if value > best:
+                        best = value
+            bound += best
+        if bound <= self._best_num:
+            return
+
+        node = self.order[depth]
+        # try the candidates with the highest immediate gain first, leaving the node unmapped is tried last
+        gains = [(weights[q] + assigned_weights[q], q) for q in self.options[depth] if pair_node2[q] not in used]
+        gains.sort(key=lambda item: -item[0])
+        for gain, q in gains:
+            node2 = pair_node2[q]
+            used.add(node2)
+            self._mapping[node] = node2
+            for other, weight in self.neighbors[q]:
+                assigned_weights[other] += weight
+            self._search(depth + 1, match_num + gain)
+            for other, weight in self.neighbors[q]:
+                assigned_weights[other] -= weight
+            self._mapping[node] = -1
+            used.discard(node2)
+            if self._stopped:
+                return
+        self._search(depth + 1, match_num)
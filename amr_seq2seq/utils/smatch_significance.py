@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Paired significance tests of the smatch difference of two systems scored against the same gold AMRs.
+
+The tests work on per-pair (match, test, gold) triple numbers saved by smatch_edited.py --pair_counts_out
+(or SmatchScript.pair_counts with keep_pair_counts), so no AMR pair is aligned again. Corpus-level smatch of a sample is
+F = 2 * match / (test + gold), so every resample only needs three weighted sums, which are computed for
+a whole batch of resamples by one matrix product.
+
+    paired bootstrap: resample AMR pairs with replacement, the same pairs for both systems
+    approximate randomization: swap the counts of the two systems of every AMR pair with probability 1/2
+
+sample_moments and sample_standard_error estimate the uncertainty of smatch computed on a random subset of
+AMR pairs (e.g. sampled validation in the Smatch metric).
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+
+import numpy as np
+
+# number of (resample, AMR pair) entries processed at once, limits memory of the resampling matrices
+BATCH_ELEMENTS = 1 << 22
+
+
+def load_pair_counts(path):
+    """
+    Load per-pair counts saved by SmatchScript.save_pair_counts.
+    Returns int64 array of shape (number of AMR pairs, 3).
+
+    """
+    return np.loadtxt(path, dtype=np.int64, ndmin=2).reshape(-1, 3)
+
+
+def f_scores(sums):
+    """
+    Smatch F-scores of (..., 3) arrays of summed (match, test, gold) triple numbers
+    (0 if there are no test or no gold triples, as in SmatchScript.compute_f).
+
+    """
+    sums = np.asarray(sums, dtype=np.float64)
+    match, test, gold = sums[..., 0], sums[..., 1], sums[..., 2]
+    denominator = test + gold
+    valid = (test > 0) & (gold > 0)
+    return np.where(valid, 2 * match / np.where(valid, denominator, 1), 0.0)
+
+
+def sample_moments(pair_counts):
+    """
+    Sufficient statistics of the F-score of a random sample of AMR pairs.
+    With y = 2 * match and x = test + gold of every pair, returns the integers
+    [n, sum(y), sum(x), sum(y * y), sum(x * y), sum(x * x)], which can be summed over processes.
+
+    """
+    counts = np.asarray(pair_counts, dtype=np.int64).reshape(-1, 3)
+    y = 2 * counts[:, 0]
+    x = counts[:, 1] + counts[:, 2]
+    return [len(counts), int(y.sum()), int(x.sum()), int(y.dot(y)), int(x.dot(y)), int(x.dot(x))]
+
+
+def sample_standard_error(moments, population_size=None):
+    """
+    Standard error of the F-score F = sum(y) / sum(x) of a simple random sample of AMR pairs
+    (ratio estimator, linearization variance). moments are given by sample_moments,
+    population_size is the number of pairs the sample was drawn from (finite population correction,
+    no correction if None). Returns 0 for samples of less than two pairs.
+
+    """
+    n, sum_y, sum_x, sum_yy, sum_xy, sum_xx = moments
+    if n < 2 or sum_x == 0:
+        return 0.0
+    ratio = sum_y / sum_x
+    # sum of squared residuals e = y - ratio * x
+    residuals = max(sum_yy - 2 * ratio * sum_xy + ratio * ratio * sum_xx, 0.0)
+    mean_x = sum_x / n
+    variance = residuals / (n - 1) / (n * mean_x * mean_x)
+    if population_size:
+        variance *= max(1 - n / population_size, 0.0)
+    return float(np.sqrt(variance))
+
+
+def _batches(resamples, pair_num):
+    batch_size = max(1, BATCH_ELEMENTS // max(pair_num, 1))
+    for start in range(0, resamples, batch_size):
+        yield min(batch_size, resamples - start)
+
+
+def paired_bootstrap(counts1, counts2, resamples=10000, seed=None):
+    """
+    F-score differences (system 2 - system 1) of paired bootstrap resamples.
+    Arguments:
+        counts1, counts2: (number of AMR pairs, 3) per-pair counts of the two systems, in the same order
+        resamples: number of bootstrap resamples
+        seed: random seed
+    Returns:
+        array of resamples differences
+
+    """
+    rng = np.random.RandomState(seed)
+    counts1 = np.asarray(counts1, dtype=np.float64)
+    counts2 = np.asarray(counts2, dtype=np.float64)
+    pair_num = len(counts1)
+    deltas = []
+    for batch_size in _batches(resamples, pair_num):
+        # weights[r, k] is how many times AMR pair k is drawn in resample r
+        indices = rng.randint(0, pair_num, size=(batch_size, pair_num))
+        indices += np.arange(batch_size)[:, None] * pair_num
+        weights = np.bincount(indices.ravel(), minlength=batch_size * pair_num).reshape(batch_size, pair_num)
+        weights = weights.astype(np.float64)
+        deltas.append(f_scores(weights.dot(counts2)) - f_scores(weights.dot(counts1)))
+    return np.concatenate(deltas) if deltas else np.zeros(0)
+
+
+def approximate_randomization(counts1, counts2, resamples=10000, seed=None):
+    """
+    F-score differences (system 2 - system 1) of approximate randomization shuffles.
+    Arguments:
+        counts1, counts2: (number of AMR pairs, 3) per-pair counts of the two systems, in the same order
+        resamples: number of shuffles
+        seed: random seed
+    Returns:
+        array of resamples differences
+
+    """
+    rng = np.random.RandomState(seed)
+    counts1 = np.asarray(counts1, dtype=np.float64)
+    counts2 = np.asarray(counts2, dtype=np.float64)
+    pair_num = len(counts1)
+    total1 = counts1.sum(axis=0)
+    total2 = counts2.sum(axis=0)
+    difference = counts2 - counts1
+    deltas = []
+    for batch_size in _batches(resamples, pair_num):
+        # swapped[r, k] is 1 if the systems exchange counts of AMR pair k in shuffle r
+        swapped = rng.randint(0, 2, size=(batch_size, pair_num)).astype(np.float64)
+        shift = swapped.dot(difference)
+        deltas.append(f_scores(total2 - shift) - f_scores(total1 + shift))
+    return np.concatenate(deltas) if deltas else np.zeros(0)
+
+
+def compare(counts1, counts2, resamples=10000, seed=None, confidence=0.95, test='both'):
+    """
+    Compare two systems.
+    Returns dictionary with the F-scores of both systems, their difference (system 2 - system 1) and:
+        bootstrap_interval: confidence interval of the difference (paired bootstrap, percentile method)
+        bootstrap_p: one-sided p-value, the fraction of resamples in which the difference does not have
+                     the observed sign
+        randomization_p: two-sided p-value of approximate randomization
+    (only the results of the selected test: "bootstrap", "randomization" or "both")
+
+    """
+    counts1 = np.asarray(counts1)
+    counts2 = np.asarray(counts2)
+    if counts1.shape != counts2.shape:
+        raise ValueError("Both systems should be scored on the same AMR pairs, got {0} and {1} pairs"
+                         .format(len(counts1), len(counts2)))
+    if not np.array_equal(counts1[:, 2], counts2[:, 2]):
+        raise ValueError("Gold triple numbers differ, both systems should be scored against the same gold AMRs "
+                         "in the same order")
+    f_score1 = float(f_scores(counts1.sum(axis=0)))
+    f_score2 = float(f_scores(counts2.sum(axis=0)))
+    delta = f_score2 - f_score1
+    result = {'f_score1': f_score1, 'f_score2': f_score2, 'difference': delta}
+    if test in ('bootstrap', 'both'):
+        deltas = paired_bootstrap(counts1, counts2, resamples=resamples, seed=seed)
+        alpha = (1 - confidence) / 2
+        result['bootstrap_interval'] = (float(np.percentile(deltas, 100 * alpha)),
+                                        float(np.percentile(deltas, 100 * (1 - alpha))))
+        result['bootstrap_p'] = float(np.mean(deltas <= 0) if delta >= 0 else np.mean(deltas >= 0))
+    if test in ('randomization', 'both'):
+        deltas = approximate_randomization(counts1, counts2, resamples=resamples, seed=seed)
+        # small tolerance, so that shuffles equal to the observed difference are not lost to rounding
+        extreme = np.sum(np.abs(deltas) >= abs(delta) - 1e-12)
+        result['randomization_p'] = float((extreme + 1) / (resamples + 1))
+    return result
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Paired significance test of smatch scores of two systems")
+    parser.add_argument('counts', nargs=2, type=str,
+                        help='Per-pair counts of system 1 and system 2 (smatch_edited.py --pair_counts_out)')
+    parser.add_argument('--resamples', type=int, default=10000, help='Number of resamples (Default: 10000)')
+    parser.add_argument('--test', default='both', choices=['bootstrap', 'randomization', 'both'], type=str,
+                        help='Paired bootstrap, approximate randomization or both (Default: both)')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='Confidence level of the bootstrap interval (Default: 0.95)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed (Default: random)')
+    parser.add_argument('--significant', type=int, default=4, help='significant digits to output (default: 4)')
+    return parser
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    result = compare(load_pair_counts(args.counts[0]), load_pair_counts(args.counts[1]),
+                     resamples=args.resamples, seed=args.seed, confidence=args.confidence, test=args.test)
+    floatdisplay = "%%.%df" % args.significant
+    print("System 1 F-score: " + floatdisplay % result['f_score1'])
+    print("System 2 F-score: " + floatdisplay % result['f_score2'])
+    print("Difference (2 - 1): " + floatdisplay % result['difference'])
+    if 'bootstrap_interval' in result:
+        print("Bootstrap {0:g}% interval: [{1}, {2}]".format(100 * args.confidence,
+                                                            floatdisplay % result['bootstrap_interval'][0],
+                                                            floatdisplay % result['bootstrap_interval'][1]))
+        print("Bootstrap p-value: " + floatdisplay % result['bootstrap_p'])
+    if 'randomization_p' in result:
+        print("Approximate randomization p-value: " + floatdisplay % result['randomization_p'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the AMR line parsers: AMR.parse_AMR_line (character loop, dict per node)
+against CompactAMR.parse_AMR_line (str tokens, parallel arrays).
+
+Every AMR of the given files is parsed, renamed and converted to triples as smatch does.
+The triples of both parsers are compared before timing.
+
+Usage: python benchmarks/parse_amr.py FILE [FILE ...] [-r REPEATS]
+
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'amr_seq2seq', 'utils'))
+
+import amr  # noqa: E402
+from smatch_edited import SmatchScript  # noqa: E402
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Benchmark of AMR line parsers")
+    parser.add_argument('files', nargs='+', help='AMR files (one-line or multi-line format)')
+    parser.add_argument('-r', '--repeats', type=int, default=5, help='Number of timed runs, best is reported')
+    return parser
+
+
+def smatch_triples(parse, line):
+    # lines are not validated, the parsers may raise on malformed ones
+    try:
+        graph = parse(line)
+    except Exception:
+        return None
+    if graph is None:
+        return None
+    graph.rename_node("a")
+    return graph.get_triples()
+
+
+def time_parser(parse, lines, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for line in lines:
+            smatch_triples(parse, line)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def memory_of_graphs(parse, lines):
+    tracemalloc.start()
+    graphs = []
+    for line in lines:
+        try:
+            graphs.append(parse(line))
+        except Exception:
+            graphs.append(None)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del graphs
+    return size
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    # both parsers log every malformed AMR
+    logging.getLogger('amr_postprocessing').setLevel(logging.CRITICAL)
+    lines = []
+    for path in args.files:
+        lines.extend(SmatchScript.iter_amr_lines(path))
+    if not lines:
+        print("No AMRs found")
+        return
+
+    mismatches = sum(smatch_triples(amr.AMR.parse_AMR_line, line) != smatch_triples(amr.CompactAMR.parse_AMR_line, line)
+                     for line in lines)
+    print("AMRs: {0}, triples differ: {1}".format(len(lines), mismatches))
+
+    parsers = [('AMR.parse_AMR_line', amr.AMR.parse_AMR_line),
+               ('CompactAMR.parse_AMR_line', amr.CompactAMR.parse_AMR_line)]
+    times = []
+    for name, parse in parsers:
+        seconds = time_parser(parse, lines, args.repeats)
+        memory = memory_of_graphs(parse, lines)
+        times.append(seconds)
+        print("{0:<26} {1:8.3f} s  {2:10.0f} AMRs/s  graphs {3:8.2f} MB".format(
+            name, seconds, len(lines) / seconds, memory / 2 ** 20))
+    print("Speedup: {0:.2f}x".format(times[0] / times[1]))
+
+
+if __name__ == "__main__":
+    main()
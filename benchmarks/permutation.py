@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Regression check and benchmark of the AMR permutation engines: the original 12 nested loops
+(get_best_perm_nested) against best_amr_permutation.get_best_perm (explicit stack, any depth).
+
+Every AMR of the given files (one per line) is pruned as prune_amrs.prune_item does, or, with --sentences,
+permuted to the word order of its sentence as best_amr_permutation.process_file_best does (AMRs without
+variables, with alignments). Outputs of get_best_perm with max_depth=12 should be the same as the outputs
+of get_best_perm_nested, outputs changed by permuting deeper levels (no depth limit) are counted.
+
+Usage: python benchmarks/permutation.py FILE [FILE ...] [--sentences FILE] [-r REPEATS] [--cut_off N] [--show N]
+
+"""
+
+import argparse
+import contextlib
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amr_seq2seq.utils import best_amr_permutation  # noqa: E402
+from amr_seq2seq.utils.best_amr_permutation import do_string_adjustments, fix_paren, get_permutations  # noqa: E402
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Regression check and benchmark of AMR permutation engines")
+    parser.add_argument('files', nargs='+', help='AMRs, one per line')
+    parser.add_argument('--sentences', default=None, help='Sentences of the AMRs, one per line (word order '
+                                                          'permutation of aligned AMRs instead of pruning)')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of timed runs, best is reported')
+    parser.add_argument('--cut_off', type=int, default=15, help='When to cut-off number of permutations')
+    parser.add_argument('--show', type=int, default=5, help='Number of differing AMRs to print')
+    return parser
+
+
+def get_best_perm_nested(permutations, keep_str, sent, final_string, all_perms, type_script, cut_off):
+    """Original version of best_amr_permutation.get_best_perm with 12 nested levels"""
+
+    for indx2, p2 in enumerate(permutations):
+        permutations_2, keep_string2, all_perms = get_permutations(p2, 2, sent, all_perms, type_script, cut_off)
+
+        for indx3, p3 in enumerate(permutations_2):
+            permutations_3, keep_string3, all_perms = get_permutations(p3, 3, sent, all_perms, type_script, cut_off)
+
+            for indx4, p4 in enumerate(permutations_3):
+                permutations_4, keep_string4, all_perms = get_permutations(p4, 4, sent, all_perms, type_script, cut_off)
+
+                for indx5, p5 in enumerate(permutations_4):
+                    permutations_5, keep_string5, all_perms = get_permutations(p5, 5, sent, all_perms, type_script,
+                                                                               cut_off)
+
+                    for indx6, p6 in enumerate(permutations_5):
+                        permutations_6, keep_string6, all_perms = get_permutations(p6, 6, sent, all_perms, type_script,
+                                                                                   cut_off)
+
+                        for indx7, p7 in enumerate(permutations_6):
+                            permutations_7, keep_string7, all_perms = get_permutations(p7, 7, sent, all_perms,
+                                                                                       type_script, cut_off)
+
+                            for indx8, p8 in enumerate(permutations_7):
+                                permutations_8, keep_string8, all_perms = get_permutations(p8, 8, sent, all_perms,
+                                                                                           type_script, cut_off)
+
+                                for indx9, p9 in enumerate(permutations_8):
+                                    permutations_9, keep_string9, all_perms = get_permutations(p9, 9, sent, all_perms,
+                                                                                               type_script, cut_off)
+
+                                    for indx10, p10 in enumerate(permutations_9):
+                                        permutations_10, keep_string10, all_perms = get_permutations(p10, 10, sent,
+                                                                                                     all_perms,
+                                                                                                     type_script,
+                                                                                                     cut_off)
+
+                                        for indx11, p11 in enumerate(permutations_10):
+                                            permutations_11, keep_string11, all_perms = get_permutations(p11, 11, sent,
+                                                                                                         all_perms,
+                                                                                                         type_script,
+                                                                                                         cut_off)
+
+                                            for indx12, p12 in enumerate(permutations_11):
+                                                permutations_12, keep_string12, all_perms = get_permutations(p12, 12,
+                                                                                                             sent,
+                                                                                                             all_perms,
+                                                                                                             type_script,
+                                                                                                             cut_off)
+                                                add_string = do_string_adjustments(permutations_12, keep_string12)
+                                                keep_string11 += add_string.replace('  ', ' ')
+
+                                            keep_string10 += fix_paren(keep_string11)
+
+                                        keep_string9 += fix_paren(keep_string10)
+
+                                    keep_string8 += fix_paren(keep_string9)
+
+                                keep_string7 += fix_paren(keep_string8)
+
+                            keep_string6 += fix_paren(keep_string7)
+
+                        keep_string5 += fix_paren(keep_string6)
+
+                    keep_string4 += fix_paren(keep_string5)
+
+                keep_string3 += fix_paren(keep_string4)
+
+            keep_string2 += fix_paren(keep_string3)
+
+        final_string += fix_paren(keep_string2)
+
+    final_string = fix_paren(final_string)
+
+    return final_string
+
+
+def permute(get_best_perm, line, sent, type_script, cut_off):
+    # the same steps as prune_amrs.prune_item and process_file_best, with the given engine
+    if type_script == 'prune':
+        line = re.sub(r'\([A-Za-z0-9-_~]+ / ', r'(', line).strip()
+    if line.count(':') <= 1:
+        return line
+    # permutations over the cut-off are shuffled, both engines get the same order
+    random.seed(0)
+    permutations, keep_string1, all_perms = best_amr_permutation.get_permutations(line, 1, sent, [], type_script,
+                                                                                  cut_off)
+    keep_str = '(' + keep_string1
+    final_string = get_best_perm(permutations, keep_str, sent, keep_str, all_perms, type_script, cut_off)
+    return " ".join(best_amr_permutation.create_final_line(final_string).split())
+
+
+def time_engine(get_best_perm, items, type_script, cut_off, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for line, sent in items:
+            permute(get_best_perm, line, sent, type_script, cut_off)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    lines = []
+    for path in args.files:
+        with open(path, 'r', encoding='utf-8') as fd:
+            lines.extend(line.strip() for line in fd if line.strip())
+    if args.sentences:
+        with open(args.sentences, 'r', encoding='utf-8') as fd:
+            sents = [line.strip() for line in fd if line.strip()]
+        if len(sents) != len(lines):
+            raise ValueError("Got {0} AMRs and {1} sentences".format(len(lines), len(sents)))
+        type_script = 'order'
+    else:
+        sents = [''] * len(lines)
+        type_script = 'prune'
+    if not lines:
+        print("No AMRs found")
+        return
+    # the permutation functions print warnings about strange AMRs
+    devnull = open(os.devnull, 'w')
+    with contextlib.redirect_stdout(devnull):
+        items, failed = [], 0
+        for line, sent in zip(lines, sents):
+            try:
+                permute(get_best_perm_nested, line, sent, type_script, args.cut_off)
+            except Exception:
+                # malformed AMRs the permutation steps can not handle, with any engine
+                failed += 1
+                continue
+            items.append((line, sent))
+
+    engines = [('nested', get_best_perm_nested),
+               ('stack, depth 12', lambda *perm_args: best_amr_permutation.get_best_perm(*perm_args, max_depth=12)),
+               ('stack', best_amr_permutation.get_best_perm)]
+    differ = 0
+    deeper = 0
+    for line, sent in items:
+        with contextlib.redirect_stdout(devnull):
+            expected = permute(engines[0][1], line, sent, type_script, args.cut_off)
+            result = permute(engines[1][1], line, sent, type_script, args.cut_off)
+            deeper += permute(engines[2][1], line, sent, type_script, args.cut_off) != expected
+        if result != expected:
+            differ += 1
+            if differ <= args.show:
+                print("AMR:             " + line)
+                print("nested:          " + expected)
+                print("stack, depth 12: " + result)
+                print()
+    print("AMRs: {0} ({1}), failed: {2}, depth 12 outputs differ: {3}, changed below depth 12: {4}".format(
+        len(items), type_script, failed, differ, deeper))
+
+    times = []
+    for name, get_best_perm in engines:
+        with contextlib.redirect_stdout(devnull):
+            seconds = time_engine(get_best_perm, items, type_script, args.cut_off, args.repeats)
+        times.append(seconds)
+        print("{0:<16} {1:8.3f} s  {2:8.3f} ms/AMR".format(name, seconds, 1000 * seconds / len(items)))
+    print("Speedup (depth 12): {0:.2f}x".format(times[0] / times[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Regression check and micro-benchmark of the variable restoring steps of restore_amr:
+the original convert + do_extra_steps (substitution loops, kept here as convert_loops + do_extra_steps_loops)
+against restore_amr.convert + restore_amr.do_extra_steps (single passes).
+
+Every prediction of the given files (one per line, as written by the model) is prepared as in
+restore_amr.process_item and restored by both versions, predictions with different outputs are reported
+before timing. Scaling with the line length is measured on multi-sentence AMRs joining 1, 2, 4, ...
+of the predictions.
+
+Usage: python benchmarks/restore_amr.py FILE [FILE ...] [-r REPEATS] [--max_sentences N] [--show N]
+
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from amr_seq2seq.utils import restore_amr  # noqa: E402
+from amr_seq2seq.utils.restore_amr import ReplaceVar, add_quotes, fix_malformed_parts, split_numbers  # noqa: E402
+from amr_seq2seq.utils.trans import restore  # noqa: E402
+
+
+def convert_loops(line):
+    """Original version of restore_amr.convert, substitution loops until the line does not change"""
+    line = line.rstrip().lstrip(' \xef\xbb\xbf\ufeff')
+    line = line.rstrip().lstrip('> ')
+
+    # global cc
+    # global c
+    # global ggg
+    ggg = 99999
+
+    replacer = ReplaceVar(c=0, cc=[])
+    old_line = line
+
+    while True:
+        line = re.sub(r'(\( ?name [^()]*:op\d+|:wiki) ([^\-_():"][^():"]*)(?=[:\)])', add_quotes, line, re.I)
+        if old_line == line:
+            break
+        old_line = line
+
+    line = re.sub(r'\(\s*([\w\-\d]+)(\W.|\))', replacer.replace_var, line)
+
+    line = re.sub(r'"(_[^"]+)"', lambda m: restore(m.group(1)), line)
+
+    open_count = 0
+    close_count = 0
+
+    for i, c in enumerate(line):
+        if c == '(':
+            open_count += 1
+        elif c == ')':
+            close_count += 1
+        if open_count == close_count and open_count > 0:
+            line = line[:i].strip()
+            break
+
+    old_line = line
+
+    while True:
+        open_count = len(re.findall(r'\(', line))
+        close_count = len(re.findall(r'\)', line))
+        if open_count > close_count:
+            line += ')' * (open_count - close_count)
+        elif close_count > open_count:
+            before = line
+            for _ in range(close_count - open_count):
+                line = line.rstrip(')')
+                line = line.rstrip(' ')
+
+        if old_line == line:
+            break
+        old_line = line
+
+    old_line = line
+
+    while True:
+        line = re.sub(r'(:\w+) ([^\W\d\-][\w\-]*)(?=\W)', replacer.replace_var2, line, re.I)
+        if old_line == line:
+            break
+        old_line = line
+
+    return fix_malformed_parts(line)
+
+
+def do_extra_steps_loops(line):
+    """Original version of restore_amr.do_extra_steps, quotes are separated character by character"""
+    line = line.replace(':', ' :')  # colon has no spaces
+    line = line.replace('(', ' (')
+    for x in range(0, 25):  # change :op0"value" to :op0 "value" as to avoid errors
+        line = line.replace(':op' + str(x) + '"', ':op' + str(x) + ' "')
+
+    line = line.replace(':value"', ':value "')
+    line = line.replace(':time"', ':time "')
+    line = line.replace(':li"', ':li "')
+    line = line.replace(':mod"', ':mod "')
+    line = line.replace(':timezone"', ':timezone "')
+    line = line.replace(':era"', ':era "')
+
+    quotes = 0
+    prev_char = 'a'
+    new_line = ''
+
+    for ch in line:
+        if ch == '"':
+            quotes += 1
+            if quotes % 2 != 0 and (new_line == '' or new_line[-1] != ' '):
+                new_line += ' "'  # add space for quote
+            else:
+                new_line += ch
+        else:
+            new_line += ch
+
+    return split_numbers(new_line)
+
+
+VERSIONS = [('loops', lambda line: do_extra_steps_loops(convert_loops(line))),
+            ('single pass', lambda line: restore_amr.do_extra_steps(restore_amr.convert(line)))]
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Regression check and benchmark of AMR variable restoring")
+    parser.add_argument('files', nargs='+', help='Predictions, one per line')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of timed runs, best is reported')
+    parser.add_argument('--max_sentences', type=int, default=64,
+                        help='Largest number of predictions joined to a multi-sentence AMR')
+    parser.add_argument('--show', type=int, default=5, help='Number of differing predictions to print')
+    return parser
+
+
+def prepare(line):
+    # steps of process_item before convert
+    line = restore_amr.preprocess(line, absolute=False)
+    line = restore_amr.remove_dangling_edges(line)
+    return restore_amr.add_space_when_digit(line)
+
+
+def multi_sentence(predictions):
+    # character-level multi-sentence prediction, as written by the model
+    parts = ['( m u l t i - s e n t e n c e']
+    for k, prediction in enumerate(predictions):
+        parts.append('+ : s n t {0} + {1}'.format(' '.join(str(k + 1)), prediction))
+    parts.append(')')
+    return ' '.join(parts)
+
+
+def time_version(restore, lines, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for line in lines:
+            restore(line)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    predictions = []
+    for path in args.files:
+        with open(path, 'r', encoding='utf-8') as fd:
+            predictions.extend(line.rstrip('\n') for line in fd if line.strip())
+    if not predictions:
+        print("No predictions found")
+        return
+    lines = [prepare(prediction) for prediction in predictions]
+
+    differ = 0
+    for prediction, line in zip(predictions, lines):
+        expected = VERSIONS[0][1](line)
+        result = VERSIONS[1][1](line)
+        if result != expected:
+            differ += 1
+            if differ <= args.show:
+                print("Prediction:  " + prediction)
+                print("Loops:       " + expected)
+                print("Single pass: " + result)
+                print()
+    print("Predictions: {0}, outputs differ: {1}".format(len(lines), differ))
+
+    times = []
+    for name, restore in VERSIONS:
+        seconds = time_version(restore, lines, args.repeats)
+        times.append(seconds)
+        print("{0:<12} {1:8.3f} s  {2:8.3f} ms/item".format(name, seconds, 1000 * seconds / len(lines)))
+    print("Speedup: {0:.2f}x".format(times[0] / times[1]))
+
+    print("\nMulti-sentence AMRs (ms/item)")
+    print("{0:>9} {1:>9} {2:>12} {3:>12}".format('sentences', 'chars', VERSIONS[0][0], VERSIONS[1][0]))
+    sentence_num = 1
+    while sentence_num <= min(args.max_sentences, len(predictions)):
+        long_lines = [prepare(multi_sentence(predictions[start:start + sentence_num]))
+                      for start in range(0, len(predictions) - sentence_num + 1, sentence_num)][:20]
+        differ = sum(VERSIONS[0][1](line) != VERSIONS[1][1](line) for line in long_lines)
+        row = [1000 * time_version(restore, long_lines, args.repeats) / len(long_lines) for _, restore in VERSIONS]
+        chars = sum(len(line) for line in long_lines) // len(long_lines)
+        print("{0:>9} {1:>9} {2:>12.3f} {3:>12.3f}{4}".format(sentence_num, chars, row[0], row[1],
+                                                             "  outputs differ: {0}".format(differ) if differ else ""))
+        sentence_num *= 2
+
+
+if __name__ == "__main__":
+    main()